@@ -0,0 +1,192 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 模擬サーバー（benchmarks/fakeServer.py）に対して放送の各処理を実行し、
+#        動画終了から次の引用までの時間・1曲あたりの通信回数・キューの処理速度を計測する
+#        また、通信の遮断後の試行が想定外の例外で終わっても遮断を解除できるかを確かめる
+#        実行 : python benchmarks/endToEnd.py --tracks 5 --latency 0.05
+
+import os
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from statistics import mean, median
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+from tracemalloc import get_traced_memory, start, stop
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from fakeServer import FakeServer, FakeState  # noqa: E402
+
+
+def report(title: str, rows: List[List[str]]):
+    print("\n## " + title)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for index, row in enumerate(rows):
+        print("  ".join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+        if index == 0:
+            print("  ".join("-" * width for width in widths))
+
+
+def callsPerTrack(before: Counter, after: Counter, tracks: int) -> str:
+    delta = after - before
+    return ", ".join("{0}={1:.1f}".format(name, count / tracks)
+                     for name, count in sorted(delta.items()))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="模擬サーバーの応答遅延（秒）")
+    parser.add_argument("--playback", type=float, default=3.0,
+                        help="先読み計測時に1曲の再生とみなす秒数")
+    parser.add_argument("--queue-sizes", default="100,1000,10000")
+    args = parser.parse_args()
+
+    state = FakeState()
+    state.defaultLatency = args.latency
+    server = FakeServer(state).start()
+    workDir = mkdtemp(prefix="nucosen-bench-")
+    # NOTE - 各モジュールは読み込み時に設定を読むため、読み込む前に設定する
+    os.environ.update(server.environment())
+    os.environ.update({
+        "QUEUE_JOURNAL_PATH": os.path.join(workDir, "queue.journal"),
+        "SQLITE_PATH": os.path.join(workDir, "bench.sqlite3"),
+        "RESERVOIR_HIGH": "0",
+        "REQTAGS": "VOCALOID",
+        "NG_TAGS": "NGTAG",
+        "CIRCUIT_COOLDOWN": "0.5",
+    })
+
+    from nucosen import (db, httpClient, live, personality, prefetch, quote,
+                         retryPolicy, sessionCookie, settings)
+    from nucosen.nucosen import prepareNext
+
+    session = sessionCookie.Session(
+        os.environ["NICO_ID"], os.environ["NICO_PW"], os.environ["NICO_TFA"])
+    session.login()
+    liveId = str(live.getLives(session)[0])
+    conf = settings.current()
+
+    # NOTE - 動画終了から次の引用完了まで
+    database = db.RestDbIo()
+    rows = [["mode", "median(s)", "mean(s)", "calls/track"]]
+    for mode in ("sequential", "prefetch"):
+        quote.videoInfoCache.clear()
+        quote.videoTagsCache.clear()
+        database.enqueueByList(
+            ["sm{0}".format(n) for n in range(1, args.tracks * 3) if n % 5 != 0])
+        prefetcher = prefetch.Prefetcher(
+            lambda: prepareNext(database, session, conf),
+            database.priorityMarker, database.priorityMarkerAfter)
+        before = Counter(state.calls)
+        transitions: List[float] = []
+        for _ in range(args.tracks):
+            if mode == "prefetch":
+                prefetcher.start()
+                sleep(args.playback)
+            startedAt = perf_counter()
+            if mode == "prefetch":
+                prepared = prefetcher.take()
+            else:
+                prepared = prepareNext(database, session, conf)
+            if prepared.itemId is not None:
+                database.remove(prepared.itemId)
+            quote.once(liveId, prepared.videoId, session, prepared.videoInfo[1])
+            transitions.append(perf_counter() - startedAt)
+        rows.append([mode, "{0:.3f}".format(median(transitions)),
+                     "{0:.3f}".format(mean(transitions)),
+                     callsPerTrack(before, Counter(state.calls), args.tracks)])
+    database.flush()
+    report("動画終了から次の引用まで（quote.onceの固定待機1.5秒を含む）", rows)
+
+    # NOTE - 大量のキューの処理速度
+    rows = [["backend", "items", "enqueue(s)", "dequeue items/s", "requests(s)", "requests peak(KiB)", "calls"]]
+    for size in [int(n) for n in args.queue_sizes.split(",")]:
+        videoIds = ["sm{0}".format(n) for n in range(1, size + 1)]
+        storages: Dict[str, db.QueueStorage] = {
+            "rest": db.RestDbIo(),
+            "sqlite": db.SqliteDbIo(os.path.join(workDir, "bench{0}.sqlite3".format(size))),
+        }
+        for name, storage in storages.items():
+            state.collections["queue"] = []
+            state.collections["requests"] = []
+            before = Counter(state.calls)
+            startedAt = perf_counter()
+            storage.enqueueByList(videoIds)
+            enqueueSeconds = perf_counter() - startedAt
+            startedAt = perf_counter()
+            dequeued = 0
+            while storage.dequeue() is not None:
+                dequeued += 1
+            dequeueSeconds = perf_counter() - startedAt
+            if isinstance(storage, db.RestDbIo):
+                storage.flush()
+                state.collections["requests"] = [
+                    {"_id": state.newRestId(), "videoId": videoId} for videoId in videoIds]
+            else:
+                storage.addRequests(videoIds)
+            startedAt = perf_counter()
+            # NOTE - リクエストの読み出しから抽選までのメモリ使用量の最大値
+            start()
+            personality.choiceFromRequests(storage.iterAndResetRequests(), 5)
+            requestPeak = get_traced_memory()[1]
+            stop()
+            requestSeconds = perf_counter() - startedAt
+            rows.append([
+                name, str(dequeued), "{0:.3f}".format(enqueueSeconds),
+                "{0:.0f}".format(dequeued / dequeueSeconds if dequeueSeconds > 0 else 0),
+                "{0:.3f}".format(requestSeconds), "{0:.0f}".format(requestPeak / 1024),
+                callsPerTrack(before, Counter(state.calls), 1)])
+    report("キューの処理速度", rows)
+
+    # NOTE - 遮断後に試しに通した通信の結果毎に、次の通信が通るか（遮断が解除されるか）
+    def raiseUnexpected(response, *args, **kwargs):
+        raise RuntimeError("probe")
+    probeUrl = "https://live2.nicovideo.jp/unama/tool/v2/onairs/user"
+    breaker = retryPolicy.breakerFor("live2.nicovideo.jp")
+    rows = [["trial", "next request"]]
+    for trial in ("success", "503", "unexpected exception"):
+        state.outages["onairs"] = 503
+        while not breaker.isOpen:
+            httpClient.get(probeUrl)
+        if trial != "503":
+            del state.outages["onairs"]
+        sleep(retryPolicy.circuitCooldown)
+        try:
+            httpClient.get(probeUrl, hooks={
+                "response": raiseUnexpected} if trial == "unexpected exception" else None)
+        except RuntimeError:
+            pass
+        state.outages.pop("onairs", None)
+        try:
+            httpClient.get(probeUrl)
+            rows.append([trial, "passed"])
+        except retryPolicy.CircuitOpen:
+            rows.append([trial, "blocked"])
+    report("サーキットブレーカーの試行", rows)
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
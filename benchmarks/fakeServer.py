@@ -0,0 +1,564 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - ニコニコ・restdb・Discordの模擬サーバー
+#        本番の放送を行わずに、通信回数や切り替え時間を計測するために使用する
+#        NUCOSEN_API_BASEにこのサーバーのURLを指定すると、
+#        https://<ホスト>/<パス> への通信は <URL>/<ホスト>/<パス> に届く
+#        単体で起動する場合 : python benchmarks/fakeServer.py --port 8765
+#        FakeAdapterを使うと、通信を行わずに同じプロセス内で応答を返す
+
+import json
+import re
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from random import Random
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+Handler = Callable[["FakeState", "FakeRequest", "re.Match[str]"], Tuple[int, Any]]
+
+
+class FakeRequest(object):
+    def __init__(self, method: str, path: str, query: Dict[str, List[str]],
+                 headers: Dict[str, str], body: Any):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def param(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        values = self.query.get(key)
+        return values[0] if values else default
+
+
+class FakeState(object):
+    # NOTE - 模擬サーバーが保持する状態
+    #        clock・sleepを差し替えると、枠の時刻と応答遅延を仮想時刻で扱える
+    def __init__(self, videoCount: int = 500, seed: int = 0,
+                 clock: Callable[[], float] = time,
+                 sleep: Callable[[float], None] = sleep):
+        self.lock = Lock()
+        self.clock = clock
+        self.sleep = sleep
+        self.random = Random(seed)
+        self.calls: Counter = Counter()
+        self.latency: Dict[str, float] = {}
+        self.defaultLatency: float = 0.0
+        # NOTE - 計測名 -> 障害時に返すステータス（503など）
+        self.outages: Dict[str, int] = {}
+        self.videos: Dict[str, Dict[str, Any]] = {}
+        for number in range(1, videoCount + 1):
+            videoId = "sm{0}".format(number)
+            tags = ["VOCALOID", "作業用BGM"]
+            if number % 17 == 0:
+                tags.append("NGTAG")
+            self.videos[videoId] = {
+                "id": videoId,
+                "title": "模擬動画{0}".format(number),
+                "length": 60 + (number * 37) % 240,
+                "quotable": number % 5 != 0,
+                "tags": tags,
+            }
+        now = int(self.clock())
+        # NOTE - 枠 : {"id", "beginAt", "endAt"}
+        self.programs: List[Dict[str, Any]] = [
+            {"id": "lv1", "beginAt": now - 60, "endAt": now + 6 * 60 * 60}]
+        self.programSerial = 1
+        # NOTE - メンテナンス時間帯 (開始UNIX時間, 終了UNIX時間)
+        self.maintenances: List[Tuple[int, int]] = []
+        # NOTE - 枠ID -> {"id", "startedAt", "repeat"}
+        self.quotations: Dict[str, Dict[str, Any]] = {}
+        self.operatorComments: List[Tuple[str, str]] = []
+        self.collections: Dict[str, List[Dict[str, Any]]] = {
+            "queue": [], "requests": []}
+        self.restSerial = 0
+        self.webhookMessages: List[str] = []
+        # NOTE - 引用・予約の履歴 {"at": UNIX時間, "kind": 種類, ...}
+        #        シミュレーションの放送記録（benchmarks/simulation.py）の元にする
+        self.events: List[Dict[str, Any]] = []
+        # NOTE - 発行済みのuser_session。expireSessionsで全て失効させる
+        self.sessions: set = set()
+        self.sessionSerial = 0
+
+    def expireSessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def record(self, kind: str, **fields: Any):
+        self.events.append(dict(at=self.clock(), kind=kind, **fields))
+
+    def newRestId(self) -> str:
+        # NOTE - restdbの_idと同様に、辞書順が作成順になるIDを振る
+        self.restSerial += 1
+        return "{0:024x}".format(self.restSerial)
+
+    def programAt(self, moment: float) -> Optional[Dict[str, Any]]:
+        for program in self.programs:
+            if program["beginAt"] <= moment < program["endAt"]:
+                return program
+        return None
+
+    def nextProgram(self, moment: float) -> Optional[Dict[str, Any]]:
+        future = [p for p in self.programs if p["beginAt"] > moment]
+        return min(future, key=lambda p: p["beginAt"]) if future else None
+
+
+# NOTE - ニコニコ
+
+
+def login(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    state.sessionSerial += 1
+    token = "user_session_{0}".format(state.sessionSerial)
+    state.sessions.add(token)
+    return (302, {"__cookies__": {"user_session": token},
+                  "__location__": "https://www.nicovideo.jp/"})
+
+
+# NOTE - 認証が必要なエンドポイントと、未認証時の応答ステータス
+AuthFailureStatus = {
+    "onairs": 401, "programinfo": 401, "operator_comment": 401, "programs": 401,
+    "quotation": 403, "video_contents": 403, "select_content": 403,
+}
+
+
+def isAuthorized(state: FakeState, request: FakeRequest) -> bool:
+    token = request.headers.get("X-niconico-session")
+    if token is None:
+        for pair in (request.headers.get("Cookie") or "").split(";"):
+            key, _, value = pair.strip().partition("=")
+            if key == "user_session":
+                token = value
+    return token in state.sessions
+
+
+def onairs(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    now = state.clock()
+    current = state.programAt(now)
+    upcoming = state.nextProgram(now)
+    return (200, {"data": {
+        "programId": current["id"] if current else None,
+        "nextProgramId": upcoming["id"] if upcoming else None,
+    }})
+
+
+def findProgram(state: FakeState, liveId: str) -> Optional[Dict[str, Any]]:
+    for program in state.programs:
+        if program["id"] == liveId:
+            return program
+    return None
+
+
+def programinfo(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    program = findProgram(state, found.group(1))
+    if program is None:
+        return (404, {"meta": {"status": 404}})
+    now = state.clock()
+    status = "ENDED" if program["endAt"] <= now else \
+        "ON_AIR" if program["beginAt"] <= now else "RESERVED"
+    return (200, {"data": {
+        "beginAt": program["beginAt"], "endAt": program["endAt"], "status": status}})
+
+
+def operatorComment(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    state.operatorComments.append((found.group(1), str((request.body or {}).get("text"))))
+    return (200, {"meta": {"status": 200}})
+
+
+def reservePrograms(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    body = request.body or {}
+    begin = int(datetime.strptime(
+        body["reservationBeginTime"], "%Y-%m-%dT%H:%M:%SZ"
+    ).replace(tzinfo=timezone.utc).timestamp())
+    end = begin + int(body["durationMinutes"]) * 60
+    for maintenanceBegin, maintenanceEnd in state.maintenances:
+        if begin < maintenanceEnd and maintenanceBegin < end:
+            state.record("reserve", beginAt=begin, endAt=end, result="OVERLAP_MAINTENANCE")
+            return (400, {"meta": {"status": 400, "errorCode": "OVERLAP_MAINTENANCE"}})
+    for program in state.programs:
+        if begin < program["endAt"] and program["beginAt"] < end:
+            state.record("reserve", beginAt=begin, endAt=end, result="OVERLAP_PROGRAM")
+            return (400, {"meta": {"status": 400, "errorCode": "OVERLAP_PROGRAM"}})
+    state.programSerial += 1
+    program = {"id": "lv{0}".format(state.programSerial), "beginAt": begin, "endAt": end}
+    state.programs.append(program)
+    state.record("reserve", beginAt=begin, endAt=end, result=program["id"])
+    return (201, {"meta": {"status": 201}, "data": {"id": program["id"]}})
+
+
+def quotation(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    liveId = found.group(1)
+    current = state.quotations.get(liveId)
+    if request.method == "GET":
+        if current is None:
+            return (404, {"meta": {"status": 404}})
+        return (200, {"currentContent": {"id": current["id"], "type": "video"}})
+    if request.method == "DELETE":
+        if current is None:
+            return (404, {"meta": {"status": 404}})
+        del state.quotations[liveId]
+        state.record("stop", liveId=liveId)
+        return (204, None)
+    if request.method == "POST":
+        if current is not None:
+            return (409, {"meta": {"status": 409}})
+        content = (request.body or {}).get("contents", [{}])[0]
+        state.quotations[liveId] = {
+            "id": content.get("id"), "startedAt": state.clock(), "repeat": False}
+        state.record("quote", liveId=liveId, videoId=content.get("id"))
+        return (201, {"meta": {"status": 201}})
+    return (405, None)
+
+
+def quotationContents(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    content = (request.body or {}).get("contents", [{}])[0]
+    state.quotations[found.group(1)] = {
+        "id": content.get("id"), "startedAt": state.clock(), "repeat": False}
+    state.record("quote", liveId=found.group(1), videoId=content.get("id"))
+    return (200, {"meta": {"status": 200}})
+
+
+def quotationLayout(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    current = state.quotations.get(found.group(1))
+    if current is None:
+        return (404, {"meta": {"status": 404}})
+    current["repeat"] = bool((request.body or {}).get("repeat", False))
+    if current["repeat"]:
+        state.record("loop", liveId=found.group(1), videoId=current["id"])
+    return (200, {"meta": {"status": 200}})
+
+
+def videoContents(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    video = state.videos.get(found.group(1))
+    if video is None:
+        return (500, {"meta": {"status": 500}})
+    return (200, {"data": {
+        "id": video["id"], "title": video["title"],
+        "length": video["length"], "quotable": video["quotable"]}})
+
+
+def selectContent(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    video = state.videos.get(found.group(1))
+    if video is None:
+        return (500, {"meta": {"status": 500}})
+    return (200, {"data": {"content": {
+        "id": video["id"], "isQuotableByOtherContents": video["quotable"]}}})
+
+
+def getthumbinfo(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    video = state.videos.get(found.group(1))
+    if video is None:
+        return (200, {"__xml__": '<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<nicovideo_thumb_response status="fail"/>'})
+    tags = "".join("<tag>{0}</tag>".format(escape(tag)) for tag in video["tags"])
+    return (200, {"__xml__": (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<nicovideo_thumb_response status="ok"><thumb>'
+        "<video_id>{0}</video_id><title>{1}</title>"
+        "<length>{2}:{3:02d}</length>"
+        '<tags domain="jp">{4}</tags>'
+        "<genre>音楽・サウンド</genre><user_id>1</user_id>"
+        "</thumb></nicovideo_thumb_response>"
+    ).format(video["id"], escape(video["title"]),
+             video["length"] // 60, video["length"] % 60, tags)})
+
+
+def snapshotSearch(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    tag = request.param("q", "")
+    minimum = int(request.param("filters[lengthSeconds][gte]", "0") or 0)
+    maximum = int(request.param("filters[lengthSeconds][lte]", "86400") or 86400)
+    limit = int(request.param("_limit", "30") or 30)
+    offset = int(request.param("_offset", "0") or 0)
+    matched = [video["id"] for video in state.videos.values()
+               if tag in video["tags"] and minimum <= video["length"] <= maximum]
+    return (200, {"meta": {"status": 200}, "data": [
+        {"contentId": videoId} for videoId in matched[offset:offset + limit]]})
+
+
+# NOTE - restdb
+
+
+def restQuery(state: FakeState, request: FakeRequest, name: str) -> List[Dict[str, Any]]:
+    items = state.collections[name]
+    query = json.loads(request.param("q", "{}") or "{}")
+    hints = json.loads(request.param("h", "{}") or "{}")
+    for key, condition in query.items():
+        if isinstance(condition, dict) and "$gt" in condition:
+            items = [i for i in items if str(i.get(key, "")) > str(condition["$gt"])]
+        else:
+            items = [i for i in items if i.get(key) == condition]
+    for key, direction in reversed(list(hints.get("$orderby", {}).items())):
+        items = sorted(items, key=lambda i: (i.get(key) is not None, i.get(key) or 0)
+                       if key != "_id" else i["_id"], reverse=direction < 0)
+    skip = int(request.param("skip", "0") or 0)
+    maximum = request.param("max")
+    items = items[skip:] if maximum is None else items[skip:skip + int(maximum)]
+    fields = hints.get("$fields")
+    if fields:
+        items = [{k: v for k, v in i.items() if k == "_id" or fields.get(k)} for i in items]
+    return items
+
+
+def restCollection(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    name, itemId = found.group(1), found.group(2)
+    if name not in state.collections:
+        return (404, None)
+    if request.method == "GET":
+        return (200, restQuery(state, request, name))
+    if request.method == "POST":
+        body = request.body
+        created = []
+        for item in (body if isinstance(body, list) else [body]):
+            record = dict(item)
+            record["_id"] = state.newRestId()
+            state.collections[name].append(record)
+            created.append(record)
+        return (201, created if isinstance(body, list) else created[0])
+    if request.method == "DELETE":
+        if itemId == "*":
+            targets = set(request.body or [])
+        else:
+            targets = {itemId}
+        before = len(state.collections[name])
+        state.collections[name] = [
+            i for i in state.collections[name] if i["_id"] not in targets]
+        if itemId != "*" and before == len(state.collections[name]):
+            return (404, None)
+        return (200, {"result": list(targets)})
+    return (405, None)
+
+
+def discordWebhook(state: FakeState, request: FakeRequest, found) -> Tuple[int, Any]:
+    state.webhookMessages.append(str((request.body or {}).get("content")))
+    return (204, None)
+
+
+# NOTE - (メソッド, パスの正規表現, 計測名, 処理)
+Routes: List[Tuple[str, "re.Pattern[str]", str, Handler]] = [
+    (m, re.compile(p), n, h) for m, p, n, h in [
+        ("POST", r"^/account\.nicovideo\.jp/login/redirector$", "login", login),
+        ("GET", r"^/live2\.nicovideo\.jp/unama/tool/v2/onairs/user$", "onairs", onairs),
+        ("GET", r"^/live2\.nicovideo\.jp/unama/watch/([^/]+)/programinfo$",
+         "programinfo", programinfo),
+        ("PUT", r"^/live2\.nicovideo\.jp/watch/([^/]+)/operator_comment$",
+         "operator_comment", operatorComment),
+        ("POST", r"^/live2\.nicovideo\.jp/unama/api/v2/programs$", "programs", reservePrograms),
+        ("*", r"^/lapi\.spi\.nicovideo\.jp/v1/(?:tools/live|services/quotation)/contents/"
+         r"([^/]+)/(?:quotation|bots)$", "quotation", quotation),
+        ("PATCH", r"^/lapi\.spi\.nicovideo\.jp/v1/(?:tools/live|services/quotation)/contents/"
+         r"([^/]+)/(?:quotation|bots)/contents$", "quotation", quotationContents),
+        ("PATCH", r"^/lapi\.spi\.nicovideo\.jp/v1/(?:tools/live|services/quotation)/contents/"
+         r"([^/]+)/(?:quotation|bots)/layout$", "quotation", quotationLayout),
+        ("GET", r"^/lapi\.spi\.nicovideo\.jp/v1/tools/live/quote/services/video/contents/([^/]+)$",
+         "video_contents", videoContents),
+        ("GET", r"^/lapi\.spi\.nicovideo\.jp/v1/services/select_content/video/([^/]+)$",
+         "select_content", selectContent),
+        ("GET", r"^/ext\.nicovideo\.jp/api/getthumbinfo/([^/]+)$", "getthumbinfo", getthumbinfo),
+        ("GET", r"^/snapshot\.search\.nicovideo\.jp/api/v2/snapshot/video/contents/search$",
+         "snapshot", snapshotSearch),
+        ("*", r"^/restdb/rest/([^/]+)(?:/([^/]+))?$", "restdb", restCollection),
+        ("POST", r"^/discord/webhook$", "discord", discordWebhook),
+    ]
+]
+
+
+def dispatch(state: FakeState, request: FakeRequest) -> Tuple[str, int, Any]:
+    for method, pattern, name, handler in Routes:
+        found = pattern.match(request.path)
+        if found is None or method not in ("*", request.method):
+            continue
+        if name == "restdb":
+            name = "restdb_" + found.group(1)
+        with state.lock:
+            state.calls[name] += 1
+            latency = state.latency.get(name, state.defaultLatency)
+        if latency > 0:
+            state.sleep(latency)
+        with state.lock:
+            if name in state.outages:
+                return (name, state.outages[name], None)
+            if name in AuthFailureStatus and not isAuthorized(state, request):
+                return (name, AuthFailureStatus[name], {"meta": {"status": AuthFailureStatus[name]}})
+            status, payload = handler(state, request, found)
+        return (name, status, payload)
+    return ("unknown", 404, None)
+
+
+def decodeBody(raw: bytes, contentType: Optional[str]) -> Any:
+    if not raw:
+        return None
+    if "json" in (contentType or ""):
+        return json.loads(raw.decode("utf-8"))
+    return {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+
+
+def encodePayload(payload: Any) -> Tuple[bytes, Dict[str, str]]:
+    headers: Dict[str, str] = {}
+    if isinstance(payload, dict) and "__xml__" in payload:
+        data = payload["__xml__"].encode("utf-8")
+        headers["Content-Type"] = "text/xml; charset=utf-8"
+    elif isinstance(payload, dict) and "__cookies__" in payload:
+        data = b""
+        for key, value in payload["__cookies__"].items():
+            headers["Set-Cookie"] = "{0}={1}; Path=/".format(key, value)
+        headers["Location"] = payload["__location__"]
+    elif payload is None:
+        data = b""
+    else:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers["Content-Type"] = "application/json; charset=utf-8"
+    return data, headers
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: FakeState
+
+    def __handle(self):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length > 0 else b""
+        request = FakeRequest(
+            self.command, parts.path, parse_qs(parts.query),
+            dict(self.headers.items()), decodeBody(raw, self.headers.get("Content-Type")))
+        _, status, payload = dispatch(self.state, request)
+        data, headers = encodePayload(payload)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = __handle
+
+    def log_message(self, format, *args):
+        return
+
+
+class FakeAdapter(HTTPAdapter):
+    # NOTE - 通信を行わずに、同じプロセス内で模擬サーバーの応答を返すrequestsのアダプター
+    #        ソケットを経由しないため、大量の通信を伴うシミュレーションで使用する
+    #        NUCOSEN_API_BASEに指定したURLにマウントする
+    def __init__(self, state: FakeState):
+        super().__init__()
+        self.state = state
+
+    def send(self, request: PreparedRequest, stream: bool = False, **kwargs) -> Response:
+        parts = urlsplit(request.url)
+        raw = request.body or b""
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        fakeRequest = FakeRequest(
+            str(request.method), parts.path, parse_qs(parts.query),
+            dict(request.headers.items()), decodeBody(raw, request.headers.get("Content-Type")))
+        _, status, payload = dispatch(self.state, fakeRequest)
+        data, headers = encodePayload(payload)
+        response = self.build_response(request, HTTPResponse(
+            body=BytesIO(data), headers=headers, status=status,
+            reason=HTTPStatus(status).phrase, preload_content=False))
+        if isinstance(payload, dict) and "__cookies__" in payload:
+            for key, value in payload["__cookies__"].items():
+                response.cookies.set(key, value, domain=parts.hostname or "", path="/")
+        if not stream:
+            response.content
+        return response
+
+
+def environmentFor(url: str) -> Dict[str, str]:
+    # NOTE - nucosenを模擬サーバーに向けるための環境変数
+    #        nucosenのモジュールを読み込む前に設定すること
+    return {
+        "NUCOSEN_API_BASE": url,
+        "QUEUE_URL": url + "/restdb/rest/queue",
+        "REQUEST_URL": url + "/restdb/rest/requests",
+        "DB_KEY": "fake",
+        "LOGGING_DISCORD_WEBHOOK": url + "/discord/webhook",
+        "NICO_ID": "fake@example.com",
+        "NICO_PW": "fake",
+        "NICO_TFA": "JBSWY3DPEHPK3PXP",
+    }
+
+
+class FakeServer(object):
+    def __init__(self, state: Optional[FakeState] = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.state = state or FakeState()
+        handler = type("BoundFakeRequestHandler", (FakeRequestHandler,),
+                       {"state": self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.__thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def environment(self) -> Dict[str, str]:
+        return environmentFor(self.url)
+
+    def start(self) -> "FakeServer":
+        self.__thread = Thread(
+            target=self.httpd.serve_forever, name="nucosen-fake-server", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = ArgumentParser(prog="python benchmarks/fakeServer.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="全エンドポイント共通の応答遅延（秒）")
+    parser.add_argument("--endpoint-latency", action="append", default=[],
+                        metavar="NAME=SECONDS", help="エンドポイント毎の応答遅延")
+    args = parser.parse_args()
+    state = FakeState()
+    state.defaultLatency = args.latency
+    for item in args.endpoint_latency:
+        name, seconds = item.split("=", 1)
+        state.latency[name] = float(seconds)
+    server = FakeServer(state, args.host, args.port)
+    for key, value in server.environment().items():
+        print("{0}={1}".format(key, value))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - リクエスト抽選（nucosen.lottery）の処理時間をリクエスト数毎に計測し、
+#        票数に比例して当選しているかを確かめる
+#        実行 : python benchmarks/lottery.py --sizes 1000,100000,1000000
+
+import random
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from nucosen.lottery import RequestLottery, countVotes, drawWeighted  # noqa: E402
+
+
+def report(title: str, rows: List[List[str]]):
+    print("\n## " + title)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for index, row in enumerate(rows):
+        print("  ".join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+        if index == 0:
+            print("  ".join("-" * width for width in widths))
+
+
+def makeBallots(size: int, videos: int, requesters: int, rng: random.Random):
+    # NOTE - 人気の偏りを再現するため、動画の選ばれやすさはZipf分布に近づける
+    weights = [1 / (rank + 1) for rank in range(videos)]
+    videoIds = rng.choices(
+        ["sm{0}".format(n) for n in range(1, videos + 1)], weights, k=size)
+    return [(videoId, "user{0}".format(rng.randrange(requesters)))
+            for videoId in videoIds]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000,300000,1000000")
+    parser.add_argument("--videos", type=int, default=20000,
+                        help="リクエストされる動画の種類")
+    parser.add_argument("--cap", type=int, default=3,
+                        help="リクエスト者毎の票数の上限（計測用）")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    rows = [["requests", "videos", "no cap(s)", "cap={0}(s)".format(args.cap), "requests/s"]]
+    for size in [int(n) for n in args.sizes.split(",")]:
+        ballots = makeBallots(size, args.videos, max(1, size // 5), rng)
+        timings = {0: [], args.cap: []}
+        for _ in range(args.repeat):
+            for cap in timings:
+                startedAt = perf_counter()
+                RequestLottery(random.Random(2)).draw(ballots, 5, cap)
+                timings[cap].append(perf_counter() - startedAt)
+        uncapped = median(timings[0])
+        rows.append([
+            str(size), str(len(countVotes(ballots)[0])),
+            "{0:.3f}".format(uncapped), "{0:.3f}".format(median(timings[args.cap])),
+            "{0:.0f}".format(size / uncapped)])
+    report("リクエスト数毎の抽選時間（5曲当選）", rows)
+
+    # NOTE - 1曲だけ当選させた場合の当選率は、票数の割合に一致するはず
+    votes = {"sm1": 6.0, "sm2": 3.0, "sm3": 1.0}
+    trials = 100000
+    wins = Counter(drawWeighted(votes, 1, rng)[0] for _ in range(trials))
+    total = sum(votes.values())
+    rows = [["video", "votes", "expected", "observed"]]
+    for videoId, weight in votes.items():
+        rows.append([videoId, "{0:.0f}".format(weight), "{0:.3f}".format(weight / total),
+                     "{0:.3f}".format(wins[videoId] / trials)])
+    report("当選率（{0}回）".format(trials), rows)
+
+
+if __name__ == "__main__":
+    main()
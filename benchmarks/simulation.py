@@ -0,0 +1,334 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 仮想時刻による放送のシミュレーション
+#        模擬サーバー（benchmarks/fakeServer.py）を通信を介さずに呼び出し、仮想時刻（clock.VirtualClock）で
+#        枠の予約・引用の切り替え・クロージングを実時間を待たずに数日分再現する
+#        放送ループにはnucosen.run（BlockingEngine）を使用する
+#        （AsyncEngineは待機を別スレッドで行うため、仮想時刻が進まない）
+#        引用・空白・予約の記録（タイムライン）をJSON Linesで出力する
+#        実行 : python benchmarks/simulation.py --days 7 --output timeline.jsonl
+#        nucosenの各モジュールは設定を読み込み時に確定するため、
+#        環境変数を設定した後に読み込む
+
+import json
+import os
+import random
+import sys
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from logging import INFO, basicConfig, getLogger
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from fakeServer import FakeAdapter, FakeState, environmentFor  # noqa: E402
+from nucosen import clock  # noqa: E402
+
+# NOTE - シナリオの既定値。開始時刻は枠の区切り（JST 4時）の直後
+DefaultScenario: Dict[str, Any] = {
+    "start": "2026-01-05T04:01:00+09:00",
+    "days": 7,
+    "seed": 0,
+    "videos": 500,
+    # NOTE - 通信1回毎に進める仮想時刻（秒）
+    "latency": 0.05,
+    # NOTE - 放送ループが異常停止した場合に、再起動するまでの仮想時刻（秒）
+    #        本番でプロセスの監視役が再起動するのと同じ扱いにする
+    "restartDelay": 10,
+    # NOTE - [[開始, 終了], ...] 枠予約がOVERLAP_MAINTENANCEで拒否される時間帯
+    "maintenances": [],
+    # NOTE - 開始時点のキュー（動画IDのリスト）とリクエスト（動画ID、または{"videoId", "requester"}）
+    "queue": [],
+    "requests": [],
+    # NOTE - 環境変数と同じ名前の設定
+    "settings": {},
+}
+
+# NOTE - 模擬サーバーのURL（通信は行わず、FakeAdapterが応答する）
+SimulationUrl = "http://nucosen.simulation"
+# NOTE - シミュレーション時の設定の既定値（シナリオのsettingsで上書きできる）
+#        チェックポイント・ログインセッションは保存せず、リザーバーは結果が揺らぐため使用しない
+DefaultSettings: Dict[str, str] = {
+    "LIVE_TITLE": "NUCOSen シミュレーション",
+    "COMMUNITY": "co0",
+    "TAGS": "NUCOSen",
+    "REQTAGS": "VOCALOID",
+    "NG_TAGS": "NGTAG",
+    "CHECKPOINT_PATH": "",
+    "RESERVOIR_HIGH": "0",
+    "SESSION_REFRESH_AGE": "0",
+}
+
+
+def parseTime(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+def formatTime(moment: float) -> str:
+    return datetime.fromtimestamp(round(moment, 3), timezone.utc).isoformat()
+
+
+def loadScenario(path: Optional[str]) -> Dict[str, Any]:
+    scenario = dict(DefaultScenario)
+    if path is not None:
+        with open(path, encoding="utf-8") as file:
+            scenario.update(json.load(file))
+    return scenario
+
+
+def prepareState(state: FakeState, scenario: Dict[str, Any], startAt: float,
+                 firstEnd: float, maintenanceVideoId: str, closingVideoId: str):
+    # NOTE - 開始時点で放送中の枠を1つだけ用意し、以降の枠は放送ループに予約させる
+    state.programs = [{"id": "lv1", "beginAt": int(startAt) - 60, "endAt": int(firstEnd)}]
+    state.maintenances = [
+        (int(parseTime(begin)), int(parseTime(end)))
+        for begin, end in scenario["maintenances"]]
+    for videoId, length in ((maintenanceVideoId, 180), (closingVideoId, 120)):
+        state.videos.setdefault(videoId, {
+            "id": videoId, "title": videoId, "length": length,
+            "quotable": True, "tags": []})
+    for videoId in scenario["queue"]:
+        state.collections["queue"].append({"_id": state.newRestId(), "videoId": videoId})
+    for request in scenario["requests"]:
+        item = {"videoId": request} if isinstance(request, str) else dict(request)
+        item["_id"] = state.newRestId()
+        state.collections["requests"].append(item)
+
+
+def coverage(state: FakeState, program: Dict[str, Any],
+             endAt: float) -> List[Dict[str, Any]]:
+    # NOTE - 枠内の引用を、開始・終了時刻の組にする
+    #        引用は動画の長さで終わるが、ループ指定の場合は次の引用・停止・枠の終了まで続く
+    #        動画の途中で次の引用・停止が行われた場合は、途切れた秒数をcutに記録する
+    #        シミュレーションの終了で打ち切った分は、途切れた秒数に含めない
+    quotes: List[Dict[str, Any]] = []
+    current: Optional[Dict[str, Any]] = None
+    limit = min(program["endAt"], endAt)
+
+    def close(at: float):
+        if current is None:
+            return
+        video = state.videos.get(current["videoId"], {})
+        natural = float("inf") if current["loop"] else \
+            current["at"] + float(video.get("length", 0))
+        finished = min(natural, at, limit)
+        current["endAt"] = finished
+        current["cut"] = 0.0 if current["loop"] or finished >= endAt \
+            else max(0.0, natural - finished)
+        quotes.append(current)
+
+    for event in state.events:
+        if event.get("liveId") != program["id"] or event["at"] >= limit:
+            continue
+        if event["kind"] == "quote":
+            close(event["at"])
+            current = {"at": event["at"], "videoId": event["videoId"], "loop": False}
+        elif event["kind"] == "loop" and current is not None:
+            current["loop"] = True
+        elif event["kind"] == "stop":
+            close(event["at"])
+            current = None
+    close(limit)
+    return quotes
+
+
+def buildTimeline(state: FakeState, startAt: float, endAt: float,
+                  maintenanceVideoId: str, closingVideoId: str) -> List[Dict[str, Any]]:
+    # NOTE - 空白（gap）は枠内で何も引用していない時間。枠の無い時間はliveIdをNoneとする
+    timeline: List[Tuple[float, int, Dict[str, Any]]] = []
+    for event in state.events:
+        if event["kind"] == "reserve":
+            timeline.append((event["at"], 0, {
+                "kind": "reserve", "at": event["at"], "beginAt": event["beginAt"],
+                "endAt": event["endAt"], "result": event["result"]}))
+        elif event["kind"] == "restart" and event["at"] < endAt:
+            timeline.append((event["at"], 0, {"kind": "restart", "at": event["at"]}))
+    onAirUntil = startAt
+    for program in sorted(state.programs, key=lambda p: p["beginAt"]):
+        beginAt, finishAt = max(program["beginAt"], startAt), min(program["endAt"], endAt)
+        if beginAt >= finishAt:
+            continue
+        if beginAt > onAirUntil:
+            timeline.append((onAirUntil, 2, {
+                "kind": "gap", "liveId": None, "at": onAirUntil, "endAt": beginAt}))
+        onAirUntil = max(onAirUntil, finishAt)
+        timeline.append((beginAt, 1, {
+            "kind": "slot", "liveId": program["id"], "at": beginAt, "endAt": finishAt}))
+        covered = beginAt
+        for quoted in coverage(state, program, endAt):
+            if quoted["at"] > covered:
+                timeline.append((covered, 2, {
+                    "kind": "gap", "liveId": program["id"], "at": covered,
+                    "endAt": quoted["at"]}))
+            role = "maintenance" if quoted["videoId"] == maintenanceVideoId else \
+                "closing" if quoted["videoId"] == closingVideoId else "video"
+            timeline.append((quoted["at"], 3, {
+                "kind": "quote", "liveId": program["id"], "at": quoted["at"],
+                "endAt": quoted["endAt"], "videoId": quoted["videoId"],
+                "role": role, "cut": quoted["cut"]}))
+            covered = max(covered, quoted["endAt"])
+        if covered < finishAt:
+            timeline.append((covered, 2, {
+                "kind": "gap", "liveId": program["id"], "at": covered, "endAt": finishAt}))
+    if onAirUntil < endAt:
+        timeline.append((onAirUntil, 2, {
+            "kind": "gap", "liveId": None, "at": onAirUntil, "endAt": endAt}))
+    return [entry for _, _, entry in sorted(timeline, key=lambda row: row[:2])]
+
+
+def summarize(timeline: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def total(kind: str, role: Optional[str] = None) -> float:
+        return sum(entry["endAt"] - entry["at"] for entry in timeline
+                   if entry["kind"] == kind and (role is None or entry.get("role") == role))
+    slotSeconds = total("slot")
+    videoSeconds = total("quote", "video")
+    reservations = [entry for entry in timeline if entry["kind"] == "reserve"]
+    return {
+        "slots": sum(1 for entry in timeline if entry["kind"] == "slot"),
+        "quotes": sum(1 for entry in timeline
+                      if entry["kind"] == "quote" and entry["role"] == "video"),
+        "maintenanceQuotes": sum(1 for entry in timeline
+                                 if entry["kind"] == "quote" and entry["role"] == "maintenance"),
+        "reservations": sum(1 for entry in reservations
+                            if entry["result"].startswith("lv")),
+        "rejectedReservations": sum(1 for entry in reservations
+                                    if not entry["result"].startswith("lv")),
+        "gaps": sum(1 for entry in timeline if entry["kind"] == "gap"),
+        "gapSeconds": round(total("gap"), 3),
+        "offAirSeconds": round(sum(entry["endAt"] - entry["at"] for entry in timeline
+                                   if entry["kind"] == "gap" and entry["liveId"] is None), 3),
+        "cutSeconds": round(sum(entry.get("cut", 0.0) for entry in timeline), 3),
+        "closingSeconds": round(total("quote", "closing"), 3),
+        "utilization": round(videoSeconds / slotSeconds, 4) if slotSeconds > 0 else 0.0,
+        "restarts": sum(1 for entry in timeline if entry["kind"] == "restart"),
+    }
+
+
+def simulate(scenario: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    logger = getLogger(__name__)
+    startAt = parseTime(scenario["start"])
+    endAt = startAt + float(scenario["days"]) * 24 * 60 * 60
+    random.seed(scenario["seed"])
+
+    scheduler = clock.Scheduler()
+    virtualClock = clock.VirtualClock(startAt, endAt, scheduler.shutdown)
+    state = FakeState(int(scenario["videos"]), int(scenario["seed"]),
+                      clock=virtualClock.timestamp, sleep=virtualClock.sleep)
+    state.defaultLatency = float(scenario["latency"])
+    workDir = tempfile.mkdtemp(prefix="nucosen-simulation-")
+    environment = dict(DefaultSettings)
+    environment.update(environmentFor(SimulationUrl))
+    del environment["LOGGING_DISCORD_WEBHOOK"]
+    environment["QUEUE_JOURNAL_PATH"] = os.path.join(workDir, "queue.journal")
+    environment.update({key: str(value) for key, value in scenario["settings"].items()})
+    os.environ.update(environment)
+
+    from nucosen import httpClient, live, nucosen, personality, settings
+    # NOTE - 通信しないため、プロキシなどの環境変数は参照しない（参照すると遅くなる）
+    httpClient.client.trust_env = False
+    httpClient.client.mount(SimulationUrl + "/", FakeAdapter(state))
+    personality.requestLottery().rng.seed(scenario["seed"])
+    conf = settings.current()
+    firstEnd = live.nextBoundaryAfter(
+        datetime.fromtimestamp(startAt, timezone.utc)).timestamp()
+    with state.lock:
+        prepareState(state, scenario, startAt, firstEnd,
+                     conf.maintenanceVideoId, conf.closingVideoId)
+
+    previous = clock.source
+    clock.source = virtualClock
+    logger.info("シミュレーションを開始します: {0} から {1}日間".format(
+        formatTime(startAt), scenario["days"]))
+    try:
+        while True:
+            try:
+                nucosen.run(scheduler)
+                break
+            except SystemExit:
+                logger.warning("放送ループが異常停止しました。再起動します: {0}".format(
+                    formatTime(virtualClock.timestamp())))
+                with state.lock:
+                    state.record("restart")
+            try:
+                scheduler.wait(clock.monotonic() + float(scenario["restartDelay"]))
+            except clock.ShutdownRequested:
+                break
+    finally:
+        finishedAt = min(virtualClock.timestamp(), endAt)
+        clock.source = previous
+
+    with state.lock:
+        timeline = buildTimeline(
+            state, startAt, finishedAt, conf.maintenanceVideoId, conf.closingVideoId)
+    summary = summarize(timeline)
+    summary["simulatedUntil"] = formatTime(finishedAt)
+    summary["apiCalls"] = sum(state.calls.values())
+    return timeline, summary
+
+
+def main():
+    parser = ArgumentParser(prog="python benchmarks/simulation.py")
+    parser.add_argument("--scenario", default=None, help="シナリオのJSONファイル")
+    parser.add_argument("--days", type=float, default=None)
+    parser.add_argument("--start", default=None, help="開始時刻（ISO 8601）")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--maintenance", action="append", default=[],
+                        metavar="BEGIN/END", help="メンテナンス時間帯（ISO 8601）")
+    parser.add_argument("--output", default="-", help="タイムラインの出力先（-は標準出力）")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--max-cut", type=float, default=None, metavar="SECONDS",
+                        help="切り替えで切れた動画の合計秒数がこれを超えたら終了コード1で終了する")
+    args = parser.parse_args()
+    basicConfig(level=args.log_level.upper(), format="%(levelname)s %(name)s %(message)s")
+    getLogger(__name__).setLevel(INFO)
+
+    scenario = loadScenario(args.scenario)
+    for key in ("days", "start", "seed"):
+        if getattr(args, key) is not None:
+            scenario[key] = getattr(args, key)
+    scenario["maintenances"] = list(scenario["maintenances"]) + [
+        item.split("/", 1) for item in args.maintenance]
+
+    timeline, summary = simulate(scenario)
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for entry in timeline:
+            entry = dict(entry)
+            for key in ("at", "endAt", "beginAt"):
+                if key in entry:
+                    entry[key] = formatTime(entry[key])
+            if "cut" in entry:
+                entry["cut"] = round(entry["cut"], 3)
+            output.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(summary, ensure_ascii=False, indent=2), file=sys.stderr)
+    # NOTE - 切り替えの先取りで動画の終わりが切れていないかの回帰確認に使用する
+    if args.max_cut is not None and summary["cutSeconds"] > args.max_cut:
+        print("cutSecondsが上限を超えました: {0} > {1}".format(
+            summary["cutSeconds"], args.max_cut), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
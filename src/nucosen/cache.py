@@ -0,0 +1,120 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+from collections import OrderedDict
+from logging import getLogger
+from os import replace
+from threading import Lock
+from typing import Any, List, Optional, Tuple
+
+from nucosen.clock import timestamp
+
+
+class TtlLruCache(object):
+    # NOTE - 有効期限付きのLRUキャッシュ
+    #        pathを指定した場合は更新の度にJSONで保存し、再起動後も引き継ぐ
+    #        （保存する値はJSONに変換できるものに限る）
+    def __init__(self, maxSize: int, path: Optional[str] = None):
+        self.maxSize = maxSize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.__lock = Lock()
+        # NOTE - キー -> (失効時刻のUNIX時間, 値)
+        self.__entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        if path:
+            self.__load()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < timestamp():
+                del self.__entries[key]
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, key: str) -> bool:
+        # NOTE - ヒット数・ミス数やLRUの順序には影響しない
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return entry is not None and entry[0] >= timestamp()
+
+    def put(self, key: str, value: Any, ttl: float):
+        with self.__lock:
+            self.__entries[key] = (timestamp() + ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxSize:
+                self.__entries.popitem(last=False)
+            if self.path:
+                self.__save()
+
+    def values(self) -> List[Any]:
+        # NOTE - 有効期限内の値の一覧。ヒット数・ミス数やLRUの順序には影響しない
+        with self.__lock:
+            now = timestamp()
+            return [entry[1] for entry in self.__entries.values() if entry[0] >= now]
+
+    def invalidate(self, key: str):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def stats(self) -> Tuple[int, int, int]:
+        # NOTE - 戻り値 : (ヒット数, ミス数, 保持数)
+        return (self.hits, self.misses, len(self.__entries))
+
+    def __load(self):
+        try:
+            with open(str(self.path), encoding="utf-8") as fp:
+                stored = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            getLogger(__name__).warning(
+                "キャッシュを読み込めませんでした {0}".format(self.path))
+            return
+        now = timestamp()
+        for key, expiresAt, value in stored[-self.maxSize:]:
+            if expiresAt >= now:
+                self.__entries[key] = (expiresAt, value)
+
+    def __save(self):
+        stored = [[key, entry[0], entry[1]]
+                  for key, entry in self.__entries.items()]
+        temporaryPath = str(self.path) + ".tmp"
+        try:
+            with open(temporaryPath, "w", encoding="utf-8") as fp:
+                json.dump(stored, fp, ensure_ascii=False)
+            replace(temporaryPath, str(self.path))
+        except OSError:
+            getLogger(__name__).warning(
+                "キャッシュを保存できませんでした {0}".format(self.path))
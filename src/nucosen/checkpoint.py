@@ -0,0 +1,100 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 放送状態のチェックポイント
+#        引用を開始する度に、枠・動画・開始時刻・終了見込み時刻を保存する
+#        異常終了後の起動時に、引用中の動画がチェックポイントと一致すれば、
+#        引用を止めずにその動画の終了を待って放送を続ける
+
+import json
+import os
+from logging import getLogger
+from threading import Lock
+from typing import NamedTuple, Optional
+
+from nucosen import clock, settings
+
+
+class Checkpoint(NamedTuple):
+    liveId: str
+    videoId: str
+    # NOTE - UNIX時間
+    startedAt: float
+    endsAt: float
+
+
+class CheckpointStore(object):
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.__lock = Lock()
+        self.__current: Optional[Checkpoint] = None
+
+    def record(self, liveId: str, videoId: str, startedAt: float, endsAt: float):
+        with self.__lock:
+            self.__current = Checkpoint(liveId, videoId, startedAt, endsAt)
+            self.__save()
+
+    def clear(self):
+        with self.__lock:
+            self.__current = None
+            self.__save()
+
+    def load(self) -> Optional[Checkpoint]:
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved is None:
+                return None
+            return Checkpoint(
+                str(saved["liveId"]), str(saved["videoId"]),
+                float(saved["startedAt"]), float(saved["endsAt"]))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            getLogger(__name__).info("チェックポイントを読み込めません {0}".format(e))
+            return None
+
+    def matches(self, liveId: str, videoId: Optional[str]) -> Optional[Checkpoint]:
+        # NOTE - 同じ枠で同じ動画を引用中で、まだ終了見込み時刻を過ぎていない場合のみ再開できる
+        checkpoint = self.load()
+        if checkpoint is None or videoId is None:
+            return None
+        if checkpoint.liveId != liveId or checkpoint.videoId != videoId:
+            return None
+        if checkpoint.endsAt <= clock.timestamp():
+            return None
+        return checkpoint
+
+    def __save(self):
+        if self.path is None:
+            return
+        temporaryPath = self.path + ".tmp"
+        try:
+            with open(temporaryPath, "w", encoding="utf-8") as file:
+                json.dump(None if self.__current is None
+                          else self.__current._asdict(), file)
+            os.replace(temporaryPath, self.path)
+        except OSError as e:
+            getLogger(__name__).warning("W80 チェックポイントを保存できません {0}".format(e))
+
+
+def openStore() -> CheckpointStore:
+    # NOTE - 空文字列を指定するとチェックポイントを使用しない
+    path = settings.lookup("CHECKPOINT_PATH", default=".nucosen-checkpoint.json")
+    return CheckpointStore(str(path) if path else None)
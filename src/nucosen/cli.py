@@ -17,13 +17,26 @@ You should have received a copy of the GNU Affero General Public License
 along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from logging import INFO, StreamHandler, Formatter, WARNING, root
+from argparse import ArgumentParser
+from logging import INFO, Handler, StreamHandler, Formatter, WARNING, root
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import List, Optional
 
-from nucosen import nucosen
+from nucosen import engines, metrics, nucosen, supervisor
 from nucosen.discordHandler import DiscordHandler
 
 
 def execute():
+    parser = ArgumentParser(prog="nucosen", description="NUCOSen Broadcast")
+    parser.add_argument(
+        "--channels", metavar="PATH",
+        help="複数チャンネルの設定ファイル（JSON）を指定し、全チャンネルを1つのプロセスで放送する")
+    parser.add_argument(
+        "--async", dest="useAsync", action="store_true",
+        help="asyncioによる放送エンジンで起動する")
+    args = parser.parse_args()
+
     stdErr = StreamHandler()
     oneLineFormat = Formatter("{asctime} [{levelname:4}] {message}", style="{")
     stdErr.setLevel(INFO)
@@ -34,8 +47,39 @@ def execute():
     discordErr.setLevel(WARNING)
     discordErr.setFormatter(twoLineFormat)
 
-    root.addHandler(stdErr)
-    root.addHandler(discordErr)
     root.setLevel(INFO)
+    metrics.startServer()
+
+    if args.channels:
+        # NOTE - どのチャンネルのログか分かるよう、チャンネル名を付ける
+        stdErr.setFormatter(Formatter(
+            "{asctime} [{levelname:4}] [{channel}] {message}", style="{"))
+        discordErr.setFormatter(Formatter(
+            '**{levelname}** [{channel}] @ ``{name}`` ({funcName})\n{message}', style="{"))
+
+    engine: engines.Engine = engines.BlockingEngine()
+    listener: Optional[QueueListener] = None
+    handlers: List[Handler] = [stdErr, discordErr]
+    if args.useAsync:
+        # NOTE - ログの出力はイベントループを止めないよう別スレッドで行う
+        engine = engines.AsyncEngine()
+        logQueue: SimpleQueue = SimpleQueue()
+        listener = QueueListener(
+            logQueue, stdErr, discordErr, respect_handler_level=True)
+        handlers = [QueueHandler(logQueue)]
+        listener.start()
+
+    for handler in handlers:
+        if args.channels:
+            # NOTE - チャンネル名はログを記録したスレッドで付ける
+            handler.addFilter(supervisor.ChannelFilter())
+        root.addHandler(handler)
 
-    nucosen.run()
+    try:
+        if args.channels:
+            supervisor.run(args.channels, engine)
+        else:
+            nucosen.run(engine=engine)
+    finally:
+        if listener is not None:
+            listener.stop()
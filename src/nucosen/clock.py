@@ -17,11 +17,186 @@ You should have received a copy of the GNU Affero General Public License
 along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+# NOTE - 単調時計による待機と、引用の切り替えにかかる時間の先取り
+#        壁時計の変更（NTPによる補正など）の影響を受けない
+#        shutdownで全ての待機を打ち切る
+#        時刻の取得と待機はsourceを通して行い、シミュレーション時は仮想時刻に差し替える
+
+import signal
+import time
 from datetime import datetime, timezone
-from time import sleep
+from logging import getLogger
+from os import getcwd
+from threading import Event, Lock, current_thread
+from typing import Callable, Dict, List, Optional, Union
+
+from decouple import AutoConfig
+
+config = AutoConfig(getcwd())
+
+# NOTE - 先取り時間の上限（秒）と、直近の計測値を重視する度合い（0～1）
+leadMax = float(config("SCHEDULER_LEAD_MAX", default=10))
+leadSmoothing = float(config("SCHEDULER_LEAD_SMOOTHING", default=0.3))
+
+
+class ShutdownRequested(Exception):
+    pass
+
+
+class WallClock(object):
+    # NOTE - 実際の時刻と待機
+    def timestamp(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event: Event, seconds: float) -> bool:
+        return event.wait(seconds)
+
+
+class VirtualClock(object):
+    # NOTE - 仮想時刻。待機すると実時間を待たずに、その分だけ時刻が進む
+    #        単調時計もUNIX時間と同じ値を返す
+    #        時刻を進めるのは作成したスレッドの待機のみで、先読みなど他のスレッドの待機は
+    #        時間がかからないものとして扱う（スレッドの実行順で結果が変わらないようにする）
+    #        endAtに達した時点でonFinishを1回だけ呼ぶ（シミュレーションの打ち切りに使用する）
+    def __init__(self, startAt: float, endAt: Optional[float] = None,
+                 onFinish: Optional[Callable[[], None]] = None):
+        self.__now = startAt
+        self.__lock = Lock()
+        self.__driver = current_thread()
+        self.endAt = endAt
+        self.onFinish = onFinish
+        self.__finished = False
+
+    def timestamp(self) -> float:
+        with self.__lock:
+            return self.__now
+
+    def monotonic(self) -> float:
+        return self.timestamp()
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def wait(self, event: Event, seconds: float) -> bool:
+        if event.is_set():
+            return True
+        self.advance(seconds)
+        return event.is_set()
+
+    def advance(self, seconds: float):
+        if current_thread() is not self.__driver:
+            return
+        with self.__lock:
+            if seconds > 0:
+                self.__now += seconds
+            finished = self.endAt is not None and self.__now >= self.endAt \
+                and not self.__finished
+            if finished:
+                self.__finished = True
+        if finished and self.onFinish is not None:
+            self.onFinish()
+
+
+source: Union[WallClock, VirtualClock] = WallClock()
+
+
+def now() -> datetime:
+    return datetime.fromtimestamp(source.timestamp(), timezone.utc)
+
+
+def timestamp() -> float:
+    return source.timestamp()
+
+
+def monotonic() -> float:
+    return source.monotonic()
+
+
+def sleep(seconds: float):
+    source.sleep(seconds)
+
+
+class Scheduler(object):
+    def __init__(self):
+        self.__stopping = Event()
+        self.__lock = Lock()
+        # NOTE - 処理名 -> 所要時間の指数移動平均（秒）
+        self.__leads: Dict[str, float] = {}
+        self.__children: List["Scheduler"] = []
+
+    def child(self) -> "Scheduler":
+        # NOTE - 待機や先取り時間は独立しているが、親のshutdownで一緒に打ち切られる
+        #        複数チャンネルの同時運用時に、チャンネル毎に使用する
+        child = Scheduler()
+        with self.__lock:
+            self.__children.append(child)
+        if self.stopping:
+            child.shutdown()
+        return child
+
+    def deadline(self, limit: datetime) -> float:
+        # NOTE - 壁時計の時刻を単調時計の時刻に変換する
+        return monotonic() + (limit - now()).total_seconds()
+
+    def wait(self, deadline: float):
+        # NOTE - 期限（monotonic）まで待つ。shutdownされた場合はShutdownRequestedを送出する
+        while True:
+            if self.__stopping.is_set():
+                raise ShutdownRequested("終了要求により待機を中断しました")
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            source.wait(self.__stopping, remaining)
+
+    def waitUntil(self, limit: datetime):
+        self.wait(self.deadline(limit))
+
+    def shutdown(self):
+        self.__stopping.set()
+        with self.__lock:
+            children = list(self.__children)
+        for child in children:
+            child.shutdown()
+
+    @property
+    def stopping(self) -> bool:
+        return self.__stopping.is_set()
+
+    def lead(self, name: str) -> float:
+        with self.__lock:
+            return min(self.__leads.get(name, 0.0), leadMax)
+
+    def observe(self, name: str, seconds: float):
+        with self.__lock:
+            previous = self.__leads.get(name)
+            self.__leads[name] = seconds if previous is None else \
+                previous + leadSmoothing * (seconds - previous)
+
+
+scheduler = Scheduler()
 
 
 def waitUntil(limit: datetime):
-    timeDelta = limit - datetime.now(timezone.utc)
-    deltaSeconds = timeDelta.total_seconds()
-    sleep(deltaSeconds if deltaSeconds > 0 else 0)
+    scheduler.waitUntil(limit)
+
+
+def installSignalHandlers(target: Optional[Scheduler] = None):
+    # NOTE - SIGTERMで待機中の処理を打ち切る
+    #        メインスレッド以外から呼ばれた場合は何もしない
+    target = target or scheduler
+
+    def handler(signum, frame):
+        getLogger(__name__).info("終了要求を受け付けました ({0})".format(
+            signal.Signals(signum).name))
+        target.shutdown()
+    try:
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        pass
@@ -17,24 +17,177 @@ You should have received a copy of the GNU Affero General Public License
 along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import atexit
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import copy_context
 from logging import getLogger
-from os import getcwd
+from os import fsync
 from re import match
-from typing import Dict, Iterable, List, Optional
+from threading import Event, Lock, Thread
+from typing import (Any, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Set, Union)
 
-from decouple import AutoConfig
-from requests import delete, get, post
 from requests.exceptions import ConnectionError as ConnError
 from requests.exceptions import HTTPError
-from retry import retry
+
+from nucosen import metrics, settings
+from nucosen.httpClient import delete, get, post
+from nucosen.retryPolicy import CircuitOpen, DeadlineExceeded, retry
 
 NetworkErrors = (HTTPError, ConnError)
 
 
-class RestDbIo(object):
+def isVideoId(item: str) -> bool:
+    return match("^[a-z][a-z][0-9]+$", item) is not None
+
+
+class Ballot(NamedTuple):
+    # NOTE - リクエスト1件。requesterはリクエスト者の識別子（受付側が記録している場合のみ）
+    videoId: str
+    requester: Optional[str] = None
+
+
+class QueuedItem(NamedTuple):
+    itemId: str
+    videoId: str
+
+
+class QueueStorage(ABC):
+    # NOTE - 放送キュー・リクエストの保存先が備えるべき操作
+    #        DB_BACKENDの設定によりopenStorageが実装を選択する
+    @abstractmethod
+    def dequeue(self) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def peek(self, limit: int) -> List[QueuedItem]:
+        # NOTE - 取り出す順にキューの先頭からlimit件を返す（取り出しはしない）
+        pass
+
+    @abstractmethod
+    def remove(self, itemId: str) -> bool:
+        # NOTE - peekで得た項目を取り出す。既に取り出されていた場合はFalse
+        pass
+
+    @abstractmethod
+    def enqueueByList(self, items: Iterable[str]):
+        pass
+
+    @abstractmethod
+    def priorityEnqueue(self, item: str):
+        pass
+
+    @abstractmethod
+    def priorityMarker(self) -> str:
+        # NOTE - キューにある最新の優先項目のID（無ければ空文字列）
+        #        他のプロセスによる優先エンキューも含めて、先読みの破棄判定に使用する
+        pass
+
+    @abstractmethod
+    def priorityMarkerAfter(self, marker: str) -> Optional[str]:
+        # NOTE - markerより後に優先エンキューされた項目があれば、その最新の項目のIDを返す（無ければNone）
+        pass
+
+    @abstractmethod
+    def iterAndResetRequests(self) -> Iterator[Ballot]:
+        # NOTE - リクエストをページ単位で読み出し、読み終えたページから削除する
+        #        全件を一度に保持しないため、リクエストが大量でもメモリ使用量は一定
+        pass
+
+    def getAndResetRequests(self) -> Optional[List[Ballot]]:
+        requests = list(self.iterAndResetRequests())
+        return requests if len(requests) else None
+
+    @abstractmethod
+    def close(self):
+        # NOTE - 放送ループの終了時に呼び出す。以降は使用しない
+        pass
+
+
+def openStorage() -> QueueStorage:
+    backend = str(settings.lookup("DB_BACKEND", default="rest")).lower()
+    if backend == "rest":
+        return RestDbIo()
+    if backend == "sqlite":
+        return SqliteDbIo()
+    raise Exception("V0E 環境変数エラー DB_BACKEND={0}".format(backend))
+
+
+class QueueJournal(object):
+    # NOTE - 取り出し済みのキュー項目IDを記録する追記型のジャーナル
+    #        "D <ID>" : 取り出し済み（データベースからの削除待ち）
+    #        "A <ID>" : データベースからの削除完了
+    #        起動時に読み直し、削除待ちの項目は再び放送しないようにする
+    def __init__(self, path: str):
+        self.path = path
+        self.__lock = Lock()
+        self.__pending: Dict[str, None] = {}
+        self.__acknowledged: Set[str] = set()
+        self.__replay()
+
+    def __replay(self):
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                for line in fp:
+                    parts = line.split()
+                    if len(parts) != 2:
+                        continue
+                    if parts[0] == "D":
+                        self.__pending[parts[1]] = None
+                    elif parts[0] == "A":
+                        self.__pending.pop(parts[1], None)
+        except FileNotFoundError:
+            return
+        if len(self.__pending) > 0:
+            getLogger(__name__).info(
+                "未削除のキュー項目をジャーナルから復元しました {0}".format(
+                    list(self.__pending)))
+
+    def __append(self, lines: List[str]):
+        with open(self.path, "a", encoding="utf-8") as fp:
+            fp.write("".join(lines))
+            fp.flush()
+            fsync(fp.fileno())
+
+    def consume(self, itemId: str):
+        with self.__lock:
+            self.__append(["D {0}\n".format(itemId)])
+            self.__pending[itemId] = None
+
+    def acknowledge(self, itemIds: List[str]):
+        with self.__lock:
+            for itemId in itemIds:
+                self.__pending.pop(itemId, None)
+                self.__acknowledged.add(itemId)
+            if len(self.__pending) == 0:
+                # NOTE - 削除待ちが無くなったらジャーナルを空にする
+                open(self.path, "w", encoding="utf-8").close()
+            else:
+                self.__append(["A {0}\n".format(i) for i in itemIds])
+
+    def pruneAcknowledged(self, remainingIds: Set[str]):
+        # NOTE - 削除済みの記録は、読み直したキューに残っている項目の分だけ保持する
+        #        （削除前に読み出したキャッシュから再び取り出さないための記録のため）
+        with self.__lock:
+            self.__acknowledged &= remainingIds
+
+    def isConsumed(self, itemId: str) -> bool:
+        with self.__lock:
+            return itemId in self.__pending or itemId in self.__acknowledged
+
+    def pendingIds(self) -> List[str]:
+        with self.__lock:
+            return list(self.__pending)
+
+
+class RestDbIo(QueueStorage):
     # TODO - 非同期実行ができるリクエストにスレッドを使って高速化
     def __init__(self):
-        config = AutoConfig(getcwd())
+        # NOTE - 複数チャンネルの同時運用時は、チャンネル毎の値を使用する
+        config = settings.lookup
         queueUrl = config("QUEUE_URL", default=None)
         requestUrl = config("REQUEST_URL", default=None)
         key = config("DB_KEY", default=None)
@@ -49,8 +202,40 @@ class RestDbIo(object):
         self.__header = header
         self.__dequeueCache: List[Dict[str, str]] = []
 
-    @retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=getLogger(__name__ + ".dequeue"))
+        # NOTE - 取り出した項目はジャーナルに記録してすぐに返し、
+        #        データベースからの削除は別スレッドでまとめて行う
+        self.__journal = QueueJournal(str(
+            config("QUEUE_JOURNAL_PATH", default=".nucosen-queue.journal")))
+        self.__ackInterval = float(config("QUEUE_ACK_INTERVAL", default=5))
+        self.__ackBatchSize = int(config("QUEUE_ACK_BATCH", default=50))
+        self.__ackRequested = Event()
+        self.__ackRequested.set()
+        self.__ackLock = Lock()
+        self.__closing = Event()
+        self.__requestPageSize = int(config("REQUEST_PAGE_SIZE", default=1000))
+        # NOTE - 読み出し済みで、削除に失敗したリクエストのID
+        #        次回の読み出しの前に削除し直し、読み出し時は数えない
+        self.__unresetRequestIds: Set[str] = set()
+        # NOTE - ログのチャンネル名を引き継ぐ
+        self.__ackThread = Thread(target=copy_context().run, args=(self.__acknowledgeLoop,),
+                                  name="nucosen-queue-ack", daemon=True)
+        self.__ackThread.start()
+        atexit.register(self.flush)
+
+    @retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".dequeue"))
+    @metrics.timed(__name__ + ".dequeue")
     def dequeue(self) -> str | None:
+        self.__refreshDequeueCache()
+        while len(self.__dequeueCache) > 0:
+            result = self.__dequeueCache.pop()
+            if self.__journal.isConsumed(result["_id"]):
+                continue
+            self.__journal.consume(result["_id"])
+            self.__ackRequested.set()
+            return result["videoId"]
+        return None
+
+    def __refreshDequeueCache(self):
         if self.isQueueUpdated:
             # 優先・エンキュー逆順
             query = '?q={}&h={"$orderby": {"priority": 1,"_id":-1}}'
@@ -59,23 +244,84 @@ class RestDbIo(object):
             queues: List[Dict[str, str]] = resp.json()
             self.__dequeueCache = queues
             self.isQueueUpdated = False
+            self.__journal.pruneAcknowledged({queue["_id"] for queue in queues})
+
+    @retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".peek"))
+    @metrics.timed(__name__ + ".peek")
+    def peek(self, limit: int) -> List[QueuedItem]:
+        self.__refreshDequeueCache()
+        items: List[QueuedItem] = []
+        for result in reversed(self.__dequeueCache):
+            if len(items) >= limit:
+                break
+            if not self.__journal.isConsumed(result["_id"]):
+                items.append(QueuedItem(result["_id"], result["videoId"]))
+        return items
+
+    def remove(self, itemId: str) -> bool:
+        if self.__journal.isConsumed(itemId):
+            return False
+        found = [result for result in self.__dequeueCache if result["_id"] == itemId]
+        if len(found) < 1:
+            return False
+        self.__dequeueCache.remove(found[0])
+        self.__journal.consume(itemId)
+        self.__ackRequested.set()
+        return True
 
-        if len(self.__dequeueCache) < 1:
-            return None
-        result = self.__dequeueCache.pop()
-        self.__deleteQueueItem(result["_id"])
-        return result["videoId"]
+    def __acknowledgeLoop(self):
+        while True:
+            self.__ackRequested.wait(self.__ackInterval)
+            self.__ackRequested.clear()
+            if self.__closing.is_set():
+                return
+            try:
+                self.__acknowledgePending()
+            except NetworkErrors as e:
+                getLogger(__name__).warning(
+                    "W02 キュー項目の削除を保留します {0}".format(e))
 
-    @retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=getLogger(__name__ + ".__deleteQueueItem"))
-    def __deleteQueueItem(self, itemId: str):
-        resp = delete(self.__queueUrl+"/"+itemId, headers=self.__header)
+    def __acknowledgePending(self):
+        with self.__ackLock:
+            pending = self.__journal.pendingIds()
+            for head in range(0, len(pending), self.__ackBatchSize):
+                itemIds = pending[head:head + self.__ackBatchSize]
+                self.__deleteQueueItems(itemIds)
+                self.__journal.acknowledge(itemIds)
+
+    def flush(self):
+        # NOTE - 削除待ちの項目をすぐにデータベースから削除する
+        #        失敗した場合はジャーナルに残り、次回起動時に削除される
+        try:
+            self.__acknowledgePending()
+        except NetworkErrors as e:
+            getLogger(__name__).warning(
+                "W02 キュー項目の削除を保留します {0}".format(e))
+
+    def close(self):
+        # NOTE - 削除用のスレッドを止めて削除待ちの項目を削除し、終了時の削除の予約も取り消す
+        #        放送ループの再起動時に、同じジャーナルへ書き込むスレッドが重複しないようにする
+        self.__closing.set()
+        self.__ackRequested.set()
+        self.__ackThread.join()
+        atexit.unregister(self.flush)
+        self.flush()
+
+    @retry(NetworkErrors, tries=3, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".__deleteQueueItems"))
+    @metrics.timed(__name__ + ".__deleteQueueItems")
+    def __deleteQueueItems(self, itemIds: List[str]):
+        resp = delete(
+            self.__queueUrl+"/*", json=itemIds, headers=self.__header)
+        if resp.status_code == 404:
+            return
         resp.raise_for_status()
 
-    @retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=getLogger(__name__ + ".enqueueByList"))
+    @retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".enqueueByList"))
+    @metrics.timed(__name__ + ".enqueueByList")
     def enqueueByList(self, items: Iterable[str]):
         payload = list()
         for item in items:
-            if match("^[a-z][a-z][0-9]+$", item):
+            if isVideoId(item):
                 payload.append({"videoId": item})
             else:
                 getLogger(__name__).error("E09 通常エンキューのアボート {0}".format(item))
@@ -85,9 +331,10 @@ class RestDbIo(object):
         resp.raise_for_status()
         self.isQueueUpdated = True
 
-    @retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=getLogger(__name__ + ".priorityEnqueue"))
+    @retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".priorityEnqueue"))
+    @metrics.timed(__name__ + ".priorityEnqueue")
     def priorityEnqueue(self, item: str):
-        if not match("^[a-z][a-z][0-9]+$", item):
+        if not isVideoId(item):
             getLogger(__name__).error("E01 優先エンキューのアボート {0}".format(item))
             return
         payload = {"videoId": item, "priority": True}
@@ -95,23 +342,231 @@ class RestDbIo(object):
         resp.raise_for_status()
         self.isQueueUpdated = True
 
-    @retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=getLogger(__name__ + ".getAndResetRequests"))
-    def getAndResetRequests(self) -> Optional[List[str]]:
-        resp = get(self.__requestUrl, headers=self.__header)
+    def priorityMarker(self) -> str:
+        newest = self.__newestPriorityItem({})
+        return "" if newest is None else newest
+
+    def priorityMarkerAfter(self, marker: str) -> Optional[str]:
+        newest = self.__newestPriorityItem({"$gt": marker} if marker else {})
+        if newest is not None:
+            # NOTE - 他のプロセスによる優先エンキューは、キャッシュを読み直すまで取り出せない
+            self.isQueueUpdated = True
+        return newest
+
+    @retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".__newestPriorityItem"))
+    @metrics.timed(__name__ + ".__newestPriorityItem")
+    def __newestPriorityItem(self, idCondition: Dict[str, str]) -> Optional[str]:
+        query: Dict[str, Any] = {"priority": True}
+        if idCondition:
+            query["_id"] = idCondition
+        params = {
+            "q": json.dumps(query),
+            "h": json.dumps({"$orderby": {"_id": -1}, "$fields": {"_id": 1}}),
+            "max": 1,
+        }
+        resp = get(self.__queueUrl, params=params, headers=self.__header)
+        resp.raise_for_status()
+        items: List[Dict[str, str]] = resp.json()
+        return items[0]["_id"] if len(items) > 0 else None
+
+    def iterAndResetRequests(self) -> Iterator[Ballot]:
+        # NOTE - _idの昇順にページを辿る（キーセット方式）ため、
+        #        途中のページを削除しても読み飛ばしや重複は起こらない
+        self.__resetRequests(sorted(self.__unresetRequestIds))
+        lastId: Optional[str] = None
+        while True:
+            try:
+                page = self.__fetchRequestPage(lastId)
+            except (*NetworkErrors, CircuitOpen, DeadlineExceeded) as e:
+                if lastId is None:
+                    raise
+                # NOTE - 読み終えたページは削除済みのため、ここで打ち切って抽選に使う
+                #        読み出せなかったリクエストは残り、次回の補充時に読み出す
+                getLogger(__name__).warning(
+                    "W04 リクエストの読み出しを途中で打ち切ります {0}".format(e))
+                return
+            for result in page:
+                if result["_id"] not in self.__unresetRequestIds:
+                    yield Ballot(result["videoId"], result.get("requester"))
+            if len(page) < 1:
+                return
+            lastId = page[-1]["_id"]
+            self.__resetRequests([result["_id"] for result in page])
+            if len(page) < self.__requestPageSize:
+                return
+
+    @retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".__fetchRequestPage"))
+    @metrics.timed(__name__ + ".__fetchRequestPage")
+    def __fetchRequestPage(self, lastId: Optional[str]) -> List[Dict[str, str]]:
+        params = {
+            "q": json.dumps({} if lastId is None else {"_id": {"$gt": lastId}}),
+            "h": json.dumps({
+                "$orderby": {"_id": 1},
+                "$fields": {"_id": 1, "videoId": 1, "requester": 1}}),
+            "max": self.__requestPageSize,
+        }
+        resp = get(self.__requestUrl, params=params, headers=self.__header)
         resp.raise_for_status()
-        results: List[Dict[str, str]] = resp.json()
-        if len(results) < 1:
-            return None
-        deletionIds = []
-        requestVideoIds = []
-        for result in results:
-            deletionIds.append(result["_id"])
-            requestVideoIds.append(result["videoId"])
-        self.__deleteRequestItems(deletionIds)
-        return requestVideoIds
-
-    @retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=getLogger(__name__ + ".__deleteRequestItems"))
+        return resp.json()
+
+    def __resetRequests(self, itemIds: List[str]):
+        # NOTE - 削除に失敗したページは次回に持ち越し、読み出しは続ける
+        self.__unresetRequestIds.update(itemIds)
+        for head in range(0, len(itemIds), self.__requestPageSize):
+            chunk = itemIds[head:head + self.__requestPageSize]
+            try:
+                self.__deleteRequestItems(chunk)
+            except NetworkErrors as e:
+                getLogger(__name__).warning(
+                    "W03 リクエストの削除を保留します {0}件 {1}".format(len(chunk), e))
+                continue
+            self.__unresetRequestIds.difference_update(chunk)
+
+    @retry(NetworkErrors, tries=3, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".__deleteRequestItems"))
+    @metrics.timed(__name__ + ".__deleteRequestItems")
     def __deleteRequestItems(self, items: List[str]):
         resp = delete(
             self.__requestUrl+"/*", json=items, headers=self.__header)
+        if resp.status_code == 404:
+            return
         resp.raise_for_status()
+
+
+class SqliteDbIo(QueueStorage):
+    # NOTE - 単一ホストで運用するための組み込みデータベース（WALモード）
+    #        リクエストの受付は同じファイルのrequestsテーブルへ書き込む
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            path = str(settings.lookup(
+                "SQLITE_PATH", default="nucosen.sqlite3"))
+        self.path = path
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                videoId TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS queueOrder ON queue (priority DESC, id);
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                videoId TEXT NOT NULL,
+                requester TEXT
+            );
+        """)
+        self.__requestPageSize = int(settings.lookup(
+            "REQUEST_PAGE_SIZE", default=1000))
+        # NOTE - requester列が無い古いファイルには列を追加する
+        columns = [row[1] for row in self.__connection.execute(
+            "PRAGMA table_info(requests)")]
+        if "requester" not in columns:
+            self.__connection.execute(
+                "ALTER TABLE requests ADD COLUMN requester TEXT")
+
+    @contextmanager
+    def __transaction(self):
+        # NOTE - 他のプロセス（リクエスト受付など）との競合を避けるため、
+        #        読み取りから書き込みまでを1つのトランザクションで行う
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                raise
+            self.__connection.execute("COMMIT")
+
+    def dequeue(self) -> Optional[str]:
+        with self.__transaction():
+            row = self.__connection.execute(
+                "SELECT id, videoId FROM queue "
+                "ORDER BY priority DESC, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.__connection.execute(
+                "DELETE FROM queue WHERE id = ?", (row[0],))
+        return str(row[1])
+
+    def peek(self, limit: int) -> List[QueuedItem]:
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT id, videoId FROM queue "
+                "ORDER BY priority DESC, id LIMIT ?", (limit,)).fetchall()
+        return [QueuedItem(str(row[0]), str(row[1])) for row in rows]
+
+    def remove(self, itemId: str) -> bool:
+        with self.__transaction():
+            cursor = self.__connection.execute(
+                "DELETE FROM queue WHERE id = ?", (int(itemId),))
+        return cursor.rowcount > 0
+
+    def enqueueByList(self, items: Iterable[str]):
+        payload = list()
+        for item in items:
+            if isVideoId(item):
+                payload.append((item,))
+            else:
+                getLogger(__name__).error("E09 通常エンキューのアボート {0}".format(item))
+        if len(payload) < 1:
+            return
+        with self.__transaction():
+            self.__connection.executemany(
+                "INSERT INTO queue (videoId) VALUES (?)", payload)
+
+    def priorityEnqueue(self, item: str):
+        if not isVideoId(item):
+            getLogger(__name__).error("E01 優先エンキューのアボート {0}".format(item))
+            return
+        with self.__transaction():
+            self.__connection.execute(
+                "INSERT INTO queue (videoId, priority) VALUES (?, 1)", (item,))
+
+    def priorityMarker(self) -> str:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT max(id) FROM queue WHERE priority = 1").fetchone()
+        return "" if row[0] is None else str(row[0])
+
+    def priorityMarkerAfter(self, marker: str) -> Optional[str]:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT max(id) FROM queue WHERE priority = 1 AND id > ?",
+                (int(marker or 0),)).fetchone()
+        return None if row[0] is None else str(row[0])
+
+    def iterAndResetRequests(self) -> Iterator[Ballot]:
+        # NOTE - ページを読み出し、全て数え終えてから削除する
+        #        途中で中断された場合、そのページのリクエストは残り、次回の補充時に読み出す
+        lastId = 0
+        while True:
+            with self.__lock:
+                rows = self.__connection.execute(
+                    "SELECT id, videoId, requester FROM requests "
+                    "WHERE id > ? ORDER BY id LIMIT ?",
+                    (lastId, self.__requestPageSize)).fetchall()
+            for row in rows:
+                yield Ballot(str(row[1]), row[2])
+            if len(rows) < 1:
+                return
+            with self.__transaction():
+                self.__connection.execute(
+                    "DELETE FROM requests WHERE id > ? AND id <= ?",
+                    (lastId, rows[-1][0]))
+            if len(rows) < self.__requestPageSize:
+                return
+            lastId = rows[-1][0]
+
+    def addRequests(self, items: Iterable[Union[str, Ballot]]):
+        with self.__transaction():
+            self.__connection.executemany(
+                "INSERT INTO requests (videoId, requester) VALUES (?, ?)",
+                ((item, None) if isinstance(item, str) else tuple(item)
+                 for item in items))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
@@ -19,12 +19,24 @@ along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
 from os import getcwd
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import List, Optional
 
-import requests
 from decouple import AutoConfig
+from requests.exceptions import RequestException
+
+from nucosen import httpClient, retryPolicy
+
+# NOTE - Discordのメッセージ1件あたりの文字数上限
+MessageLimit = 2000
 
 
 class DiscordHandler(logging.StreamHandler):
+    # NOTE - ログは待ち行列に積むだけで、送信は別スレッドで行う
+    #        溜まったログは上限文字数の範囲で1件のメッセージにまとめ、
+    #        待ち行列が溢れた場合は件数のみを後で報告する
     def __init__(self):
         super().__init__()
         config = AutoConfig(search_path=getcwd())
@@ -34,13 +46,110 @@ class DiscordHandler(logging.StreamHandler):
         if self.url == "BAD_URL":
             raise Exception(
                 "START UP ERROR : LOGGING_DISCORD_WEBHOOK is not available.")
+        self.shutdownTimeout = float(
+            config("DISCORD_LOG_SHUTDOWN_TIMEOUT", default=10))
+        self.__queue: "Queue[Optional[str]]" = Queue(
+            int(config("DISCORD_LOG_BUFFER", default=200)))
+        self.__droppedLock = Lock()
+        self.__dropped = 0
+        self.__worker = Thread(
+            target=self.__work, name="nucosen-discord", daemon=True)
+        self.__worker.start()
 
     def emit(self, record):
-        msg = self.format(record)
-        self.send_message(msg)
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.__queue.put_nowait(msg)
+        except Full:
+            with self.__droppedLock:
+                self.__dropped += 1
+
+    def __work(self):
+        while True:
+            first = self.__queue.get()
+            if first is None:
+                self.__queue.task_done()
+                return
+            batch = [first]
+            finished = False
+            while sum(len(msg) + 1 for msg in batch) < MessageLimit:
+                try:
+                    msg = self.__queue.get_nowait()
+                except Empty:
+                    break
+                if msg is None:
+                    finished = True
+                    self.__queue.task_done()
+                    break
+                batch.append(msg)
+            with self.__droppedLock:
+                dropped, self.__dropped = self.__dropped, 0
+            if dropped > 0:
+                batch.append("（送信が追いつかないため、ログ{0}件を省略しました）".format(dropped))
+            for message in packMessages(batch):
+                self.send_message(message)
+            for _ in range(len(batch) - (1 if dropped > 0 else 0)):
+                self.__queue.task_done()
+            if finished:
+                return
 
     def send_message(self, text):
         message = {
             'content': text
         }
-        requests.post(self.url, json=message)
+        for _ in range(5):
+            try:
+                resp = httpClient.post(self.url, json=message)
+            except (RequestException, retryPolicy.CircuitOpen):
+                return
+            if resp.status_code != 429:
+                return
+            # NOTE - レート制限中は指示された秒数だけ待つ
+            retryAfter = resp.headers.get("Retry-After")
+            if retryAfter is None:
+                try:
+                    retryAfter = resp.json().get("retry_after", 1)
+                except ValueError:
+                    retryAfter = 1
+            sleep(float(retryAfter))
+
+    def flush(self):
+        # NOTE - 送信待ちが無くなるまで待つ（最大DISCORD_LOG_SHUTDOWN_TIMEOUT秒）
+        deadline = monotonic() + self.shutdownTimeout
+        while self.__worker.is_alive() and self.__queue.unfinished_tasks > 0:
+            if monotonic() > deadline:
+                return
+            sleep(0.05)
+
+    def close(self):
+        if self.__worker.is_alive():
+            try:
+                self.__queue.put(None, timeout=self.shutdownTimeout)
+            except Full:
+                pass
+            self.__worker.join(self.shutdownTimeout)
+        super().close()
+
+
+def packMessages(records: List[str]) -> List[str]:
+    # NOTE - 上限文字数を超えないよう改行区切りで結合する
+    #        1件で上限を超えるものは末尾を切り詰める
+    messages: List[str] = []
+    current = ""
+    for record in records:
+        if len(record) > MessageLimit:
+            record = record[:MessageLimit - 3] + "..."
+        if current == "":
+            current = record
+        elif len(current) + 1 + len(record) <= MessageLimit:
+            current += "\n" + record
+        else:
+            messages.append(current)
+            current = record
+    if current != "":
+        messages.append(current)
+    return messages
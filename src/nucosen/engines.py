@@ -0,0 +1,64 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 放送ループ（nucosen.broadcast）の実行方式
+#        放送ループはコルーチンとして1つだけ書き、通信・待機は全てengine.callを通して行う
+#        ・BlockingEngine : 呼び出し元のスレッドでそのまま実行する（従来の動作・既定）
+#        ・AsyncEngine    : asyncioのイベントループ上で実行し、通信・待機は別スレッドで行う
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Coroutine, TypeVar
+
+Result = TypeVar("Result")
+
+
+class Engine(ABC):
+    @abstractmethod
+    async def call(self, function: Callable[..., Result], *args, **kwargs) -> Result:
+        # NOTE - live・quote・dbなどの操作を実行し、結果を返す
+        pass
+
+    @abstractmethod
+    def run(self, coroutine: Coroutine[Any, Any, Result]) -> Result:
+        # NOTE - 放送ループを最後まで実行する
+        pass
+
+
+class BlockingEngine(Engine):
+    async def call(self, function: Callable[..., Result], *args, **kwargs) -> Result:
+        return function(*args, **kwargs)
+
+    def run(self, coroutine: Coroutine[Any, Any, Result]) -> Result:
+        # NOTE - callは中断しないため、イベントループを使わずに1回で最後まで進む
+        try:
+            coroutine.send(None)
+        except StopIteration as finished:
+            return finished.value
+        coroutine.close()
+        raise RuntimeError("放送ループがengine.callを通さずに中断しました")
+
+
+class AsyncEngine(Engine):
+    async def call(self, function: Callable[..., Result], *args, **kwargs) -> Result:
+        # NOTE - to_threadはリトライの期限やチャンネル毎の設定などのコンテキストを引き継ぐ
+        return await asyncio.to_thread(function, *args, **kwargs)
+
+    def run(self, coroutine: Coroutine[Any, Any, Result]) -> Result:
+        return asyncio.run(coroutine)
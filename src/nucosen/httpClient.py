@@ -0,0 +1,153 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from http.cookiejar import DefaultCookiePolicy
+from logging import getLogger
+from os import getcwd
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from decouple import AutoConfig
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as ConnError
+from requests.exceptions import Timeout as RequestTimeout
+
+from nucosen import metrics, retryPolicy
+
+config = AutoConfig(getcwd())
+
+UserAgent = str(config("NUCOSEN_UA_PREFIX", default="anonymous")
+                ) + " / NUCOSen Broadcast"
+# NOTE - (接続確立, 応答待ち) 秒
+Timeout = (
+    float(config("HTTP_CONNECT_TIMEOUT", default=5)),
+    float(config("HTTP_READ_TIMEOUT", default=30))
+)
+# NOTE - プールを保持するホスト数と、ホスト毎に保持する接続数
+PoolConnections = int(config("HTTP_POOL_CONNECTIONS", default=16))
+PoolMaxSize = int(config("HTTP_POOL_MAXSIZE", default=8))
+# NOTE - 指定すると https://<ホスト>/<パス> への通信を <指定先>/<ホスト>/<パス> へ送る
+#        検証用の模擬サーバー（benchmarks/fakeServer.py）を使用する際に指定する
+ApiBase = str(config("NUCOSEN_API_BASE", default="")).rstrip("/")
+
+
+class PooledSession(Session):
+    def __init__(self):
+        super().__init__()
+        self.headers["User-Agent"] = UserAgent
+        # NOTE - ログインセッションはSessionオブジェクト毎に渡すため、
+        #        共有プール側では一切のクッキーを保持しない
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=PoolConnections,
+            pool_maxsize=PoolMaxSize
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs) -> Response:
+        kwargs.setdefault("timeout", Timeout)
+        target = rewriteUrl(url) if ApiBase else url
+        hostName = urlsplit(url).hostname or ""
+        breaker = retryPolicy.breakerFor(hostName)
+        breaker.before()
+        startedAt = perf_counter()
+        status: Optional[int] = None
+        try:
+            response = super().request(method, target, *args, **kwargs)
+            status = response.status_code
+        except (ConnError, RequestTimeout):
+            breaker.failure()
+            raise
+        except BaseException:
+            # NOTE - 試しに通した通信の結果が分からないまま、遮断が解除できなくならないようにする
+            breaker.abandon()
+            raise
+        finally:
+            if metrics.enabled:
+                metrics.observeHttp(
+                    hostName, method.upper(), perf_counter() - startedAt, status)
+        # NOTE - 上流の停止を示す応答のみ失敗として数える
+        #        （引用APIは削除済み動画に500を返すため、500は数えない）
+        if status in (502, 503, 504):
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+
+def rewriteUrl(url: str) -> str:
+    parts = urlsplit(url)
+    if parts.scheme != "https" or parts.hostname is None:
+        return url
+    rewritten = "{0}/{1}{2}".format(ApiBase, parts.hostname, parts.path)
+    if parts.query:
+        rewritten += "?" + parts.query
+    return rewritten
+
+
+client = PooledSession()
+
+
+def get(url, params=None, **kwargs) -> Response:
+    return client.get(url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs) -> Response:
+    return client.post(url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs) -> Response:
+    return client.put(url, data=data, **kwargs)
+
+
+def patch(url, data=None, **kwargs) -> Response:
+    return client.patch(url, data=data, **kwargs)
+
+
+def delete(url, **kwargs) -> Response:
+    return client.delete(url, **kwargs)
+
+
+def getPoolStats() -> Dict[str, Tuple[int, int]]:
+    # NOTE - 戻り値 : {ホスト: (リクエスト数, 新規接続数)}
+    #        リクエスト数 - 新規接続数 が接続の再利用回数
+    stats: Dict[str, Tuple[int, int]] = {}
+    for adapter in set(client.adapters.values()):
+        if not isinstance(adapter, HTTPAdapter):
+            continue
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests, connections = stats.get(pool.host, (0, 0))
+            stats[pool.host] = (
+                requests + pool.num_requests,
+                connections + pool.num_connections
+            )
+    return stats
+
+
+def logPoolStats():
+    for host, (requests, connections) in sorted(getPoolStats().items()):
+        getLogger(__name__).info("接続再利用状況 {0}: リクエスト {1} / 新規接続 {2}".format(
+            host, requests, connections))
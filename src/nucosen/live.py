@@ -22,12 +22,14 @@ from logging import getLogger
 from typing import Any, Dict, List, Optional, Tuple
 import sys
 
-from requests import get, post, put
 from requests.exceptions import ConnectionError as ConnError
 from requests.exceptions import HTTPError
 from requests.models import Response
-from retry import retry
 
+from nucosen import clock, metrics, reservation, settings
+from nucosen.cache import TtlLruCache
+from nucosen.httpClient import get, post, put
+from nucosen.retryPolicy import retry
 from nucosen.sessionCookie import Session
 from decouple import AutoConfig
 from os import getcwd
@@ -45,12 +47,20 @@ config = AutoConfig(getcwd())
 
 NetworkErrors = (HTTPError, ConnError, ReLoggedIn)
 UserAgent = str(config("NUCOSEN_UA_PREFIX", default="anonymous")) + " / NUCOSen Backend"
+# NOTE - 枠情報（現枠・次枠、開始・終了時刻）をキャッシュする秒数
+programStateTtl = float(config("PROGRAM_STATE_TTL", default=60))
+livesCache = TtlLruCache(16)
+programInfoCache = TtlLruCache(64)
+# NOTE - 枠予約で判明したメンテナンスの位置
+maintenanceMemory = reservation.MaintenanceMemory(TtlLruCache(
+    256, config("MAINTENANCE_MEMORY_PATH", default=None)))
 
 
 @retry(
-    NetworkErrors, tries=5, delay=1, backoff=2, logger=getLogger(__name__ + ".getLives")
+    NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".getLives")
 )
-def getLives(session: Session) -> Tuple[Optional[str], Optional[str]]:
+@metrics.timed(__name__ + ".getLives")
+def fetchLives(session: Session) -> Tuple[Optional[str], Optional[str]]:
     # NOTE - 戻り値 : (オンエア枠, 次枠)
     if session.cookie is None:
         session.login()
@@ -73,6 +83,22 @@ def getLives(session: Session) -> Tuple[Optional[str], Optional[str]]:
     return (currentProgram, nextProgram)
 
 
+def getLives(session: Session) -> Tuple[Optional[str], Optional[str]]:
+    # NOTE - 戻り値 : (オンエア枠, 次枠)
+    #        枠は枠の切り替わりと予約でしか変化しないので、短時間キャッシュする
+    cached = livesCache.get(session.mail_tel)
+    if cached is None:
+        cached = fetchLives(session)
+        livesCache.put(session.mail_tel, list(cached), programStateTtl)
+    return (cached[0], cached[1])
+
+
+def invalidateProgramState():
+    # NOTE - 枠の予約時・枠の切り替わり時に呼び出す
+    livesCache.clear()
+    programInfoCache.clear()
+
+
 def sGetLives(session: Session) -> Tuple[str, str]:
     result = getLives(session)
     if result[0] is None or result[1] is None:
@@ -89,8 +115,9 @@ def sGetLives(session: Session) -> Tuple[str, str]:
     tries=10,
     delay=1,
     backoff=2,
-    logger=getLogger(__name__ + ".showMessage"),
+    logger=metrics.retryLogger(__name__ + ".showMessage"),
 )
+@metrics.timed(__name__ + ".showMessage")
 def showMessage(liveId: str, msg: str, session: Session, *, permanent: bool = False):
     url = "https://live2.nicovideo.jp/watch/{0}/operator_comment".format(liveId)
     payload = {"text": msg, "isPermanent": permanent}
@@ -98,7 +125,7 @@ def showMessage(liveId: str, msg: str, session: Session, *, permanent: bool = Fa
     resp = put(url, json=payload, headers=header, cookies=session.cookie)
 
     # NOTE - 調査中！
-    if resp.status_code in (400):
+    if resp.status_code == 400:
         getLogger(__name__).error(
             "現在調査中のエラーです。「Issue 141」と添えて次のエラーメッセージを開発者に報告してください。"
         )
@@ -159,8 +186,9 @@ def generateLiveDict(category: str, communityId: str, tags: List[str]):
     tries=10,
     delay=1,
     backoff=2,
-    logger=getLogger(__name__ + ".takeReservation"),
+    logger=metrics.retryLogger(__name__ + ".takeReservation"),
 )
+@metrics.timed(__name__ + ".takeReservation")
 def takeReservation(
     liveDict: Dict[Any, Any], startTime: datetime, duration: int, session: Session
 ) -> Response:
@@ -191,7 +219,7 @@ def takeReservation(
 def getStartTimeOfNextLive(now: Optional[datetime] = None) -> datetime:
     JST = timezone(timedelta(hours=9))
     if now is None:
-        now = datetime.now(tz=JST)
+        now = clock.now().astimezone(JST)
     else:
         now = now.astimezone(JST)
     tomorrow = now.date() + timedelta(days=1)
@@ -214,40 +242,24 @@ def getStartTimeOfNextLive(now: Optional[datetime] = None) -> datetime:
     return startCandidate.astimezone(timezone.utc)
 
 
+def nextBoundaryAfter(moment: datetime) -> datetime:
+    # NOTE - momentが区切りちょうどの場合は、その次の区切りを返す
+    return getStartTimeOfNextLive(moment + timedelta(minutes=1))
+
+
 def reserveLiveToGetOverMaintenance(
     liveDict: Dict[Any, Any], defaultStartTime: datetime, session: Session
-):
-    endTime = getStartTimeOfNextLive(defaultStartTime)
-    currentDurationObject = endTime - defaultStartTime
-    currentDuration = currentDurationObject.seconds // 60
-    print(currentDuration)
-    if currentDuration == 0:
-        getLogger(__name__).warning("W21 枠予約アボート")
-    else:
-        while currentDuration > 0:
-            resp = takeReservation(liveDict, defaultStartTime, currentDuration, session)
-            if resp.status_code == 201:
-                break
-            currentDuration -= 30
-            print(defaultStartTime.isoformat(), currentDuration, sep=" /// ")
-            print(resp.text)
-        else:
-            getLogger(__name__).error("E20 枠予約失敗")
-
-    currentStartTime: datetime = defaultStartTime + timedelta(currentDuration)
-    for _ in range(24 * 60 // 30):
-        # NOTE : 24時間後でも取れない場合はアボート
-        endTime = getStartTimeOfNextLive(currentStartTime)
-        liveDurationObject = endTime - currentStartTime
-        liveDuration = liveDurationObject.seconds // 60
-        resp = takeReservation(liveDict, currentStartTime, liveDuration, session)
+) -> reservation.ReservationCost:
+    def probe(startTime: datetime, duration: int) -> bool:
+        resp = takeReservation(liveDict, startTime, duration, session)
         if resp.status_code == 201:
-            break
-        currentStartTime += timedelta(minutes=30)
-        print(endTime, liveDuration, sep=" /// ")
-        print(resp.text)
-    else:
-        getLogger(__name__).error("E21 枠予約失敗")
+            getLogger(__name__).info("予約完了/{0} {1}分".format(
+                startTime.isoformat(), duration))
+            return True
+        return False
+
+    return reservation.reserveAroundMaintenance(
+        probe, defaultStartTime, nextBoundaryAfter, maintenanceMemory)
 
 
 @retry(
@@ -255,14 +267,22 @@ def reserveLiveToGetOverMaintenance(
     tries=10,
     delay=1,
     backoff=2,
-    logger=getLogger(__name__ + ".reserveLive"),
+    logger=metrics.retryLogger(__name__ + ".reserveLive"),
 )
+@metrics.timed(__name__ + ".reserveLive")
 def reserveLive(
     title: str, communityId: str, tags: List[str], session: Session
 ) -> None:
     liveDict = generateLiveDict(title, communityId, tags)
     startTime = getStartTimeOfNextLive()
-    duration: int = config("DURATION_OVERWRITE", default=360, cast=int)
+    duration: int = settings.current().duration
+
+    endTime = startTime + timedelta(minutes=duration)
+    if maintenanceMemory.blocks(startTime, endTime):
+        getLogger(__name__).info("既知のメンテナンスと重なるため、回避して予約します")
+        reserveLiveToGetOverMaintenance(liveDict, startTime, session)
+        invalidateProgramState()
+        return
 
     response = takeReservation(liveDict, startTime, duration, session)
     responseJson: dict = response.json()
@@ -273,8 +293,11 @@ def reserveLive(
         return
     elif responseMeta["status"] == 201:
         getLogger(__name__).info("予約完了/{0}".format(responseJson))
+        invalidateProgramState()
     elif responseMeta.get("errorCode", "") == "OVERLAP_MAINTENANCE":
+        maintenanceMemory.remember(startTime, endTime)
         reserveLiveToGetOverMaintenance(liveDict, startTime, session)
+        invalidateProgramState()
     else:
         response.raise_for_status()
 
@@ -284,29 +307,50 @@ def reserveLive(
     tries=5,
     delay=1,
     backoff=2,
-    logger=getLogger(__name__ + ".getStartTime"),
+    logger=metrics.retryLogger(__name__ + ".getProgramInfo"),
 )
-def getStartTime(liveId: str, session: Session) -> datetime:
+@metrics.timed(__name__ + ".getProgramInfo")
+def fetchProgramInfo(liveId: str, session: Session) -> Optional[Dict[str, Any]]:
+    # NOTE - 戻り値 : {"beginAt": UNIX時間, "endAt": UNIX時間, "status": 状態}
+    #        枠が存在しない場合はNone
     url = "https://live2.nicovideo.jp/unama/watch/{0}/programinfo".format(liveId)
     response = get(url, cookies=session.cookie)
     if response.status_code == 401:
         session.login()
         raise ReLoggedIn("L04 ログインセッション更新")
-    response.raise_for_status()
-    result = response.json()
-    beginUnixTime = int(result["data"]["beginAt"])
-    return datetime.fromtimestamp(beginUnixTime, timezone.utc)
-
-
-def getEndTime(liveId: str, session: Session) -> datetime:
-    url = "https://live2.nicovideo.jp/unama/watch/{0}/programinfo".format(liveId)
-    response = get(url, cookies=session.cookie)
-    if response.status_code == 401:
+    if response.status_code == 403:
         session.login()
         raise ReLoggedIn("L05 ログインセッション更新")
     if response.status_code == 404:
-        return datetime.now(timezone.utc)
+        return None
     response.raise_for_status()
-    result = response.json()
-    beginUnixTime = int(result["data"]["endAt"])
-    return datetime.fromtimestamp(beginUnixTime, timezone.utc)
+    result = dict(response.json()).get("data", {})
+    return {
+        "beginAt": int(result["beginAt"]),
+        "endAt": int(result["endAt"]),
+        "status": result.get("status", None),
+    }
+
+
+def getProgramInfo(liveId: str, session: Session) -> Optional[Dict[str, Any]]:
+    cached = programInfoCache.get(liveId)
+    if cached is None:
+        cached = fetchProgramInfo(liveId, session)
+        if cached is None:
+            return None
+        programInfoCache.put(liveId, cached, programStateTtl)
+    return cached
+
+
+def getStartTime(liveId: str, session: Session) -> datetime:
+    programInfo = getProgramInfo(liveId, session)
+    if programInfo is None:
+        raise NotExpectedResult("V11 枠情報取得エラー {0}".format(liveId))
+    return datetime.fromtimestamp(programInfo["beginAt"], timezone.utc)
+
+
+def getEndTime(liveId: str, session: Session) -> datetime:
+    programInfo = getProgramInfo(liveId, session)
+    if programInfo is None:
+        return clock.now()
+    return datetime.fromtimestamp(programInfo["endAt"], timezone.utc)
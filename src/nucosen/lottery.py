@@ -0,0 +1,97 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import random
+from heapq import nsmallest
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+# NOTE - リクエスト1件。動画IDのみ、または（動画ID, リクエスト者）
+BallotLike = Union[str, Tuple[str, Optional[str]]]
+# NOTE - 持ち越した票がこれを下回ったら忘れる
+minimumCarry = 0.05
+
+
+def countVotes(ballots: Iterable[BallotLike], perRequester: int = 0) -> Tuple[Dict[str, float], int]:
+    # NOTE - 1回の走査で動画毎の票数を数える。戻り値は（票数, 数えた票の数）
+    #        perRequesterが1以上の場合、同じリクエスト者の票はその数までしか数えない
+    votes: Dict[str, float] = {}
+    casted: Dict[str, int] = {}
+    counted = 0
+    for ballot in ballots:
+        if isinstance(ballot, str):
+            videoId, requester = ballot, None
+        else:
+            videoId, requester = ballot
+        if perRequester > 0 and requester is not None:
+            castedCount = casted.get(requester, 0)
+            if castedCount >= perRequester:
+                continue
+            casted[requester] = castedCount + 1
+        votes[videoId] = votes.get(videoId, 0) + 1
+        counted += 1
+    return votes, counted
+
+
+def drawWeighted(votes: Dict[str, float], choicesNum: int,
+                 rng: Optional[random.Random] = None) -> List[str]:
+    # NOTE - 票数に比例した重み付きの非復元抽出（Efraimidis-Spirakis法）
+    #        各動画に「票数を率とする指数分布」の乱数を振り、小さい順に当選とする
+    #        当選順に並べて返す。計算量は O(動画数 × log 当選数)
+    expovariate = (rng or random).expovariate
+    keyed = ((expovariate(weight), videoId)
+             for videoId, weight in votes.items() if weight > 0)
+    return [videoId for _, videoId in nsmallest(choicesNum, keyed)]
+
+
+class RequestLottery(object):
+    # NOTE - リクエスト抽選。落選した動画の票は carryOver 倍して次回の抽選に持ち越す
+    #        （0の場合は持ち越さない）
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng or random.Random()
+        self.carried: Dict[str, float] = {}
+        self.__lock = Lock()
+
+    def draw(self, ballots: Iterable[BallotLike], choicesNum: int,
+             perRequester: int = 0, carryOver: float = 0.0) -> List[str]:
+        with self.__lock:
+            return self.__draw(ballots, choicesNum, perRequester, carryOver)
+
+    def __draw(self, ballots: Iterable[BallotLike], choicesNum: int,
+               perRequester: int, carryOver: float) -> List[str]:
+        startedAt = perf_counter()
+        votes, counted = countVotes(ballots, perRequester)
+        for videoId, weight in self.carried.items():
+            votes[videoId] = votes.get(videoId, 0) + weight
+        candidates = len(votes)
+        winners = drawWeighted(votes, choicesNum, self.rng)
+        self.carried = {}
+        if carryOver > 0:
+            for videoId in winners:
+                del votes[videoId]
+            self.carried = {
+                videoId: weight * carryOver for videoId, weight in votes.items()
+                if weight * carryOver >= minimumCarry}
+        getLogger(__name__).info(
+            "リクエスト抽選: {0}票・{1}曲から{2}曲当選（持ち越し{3}曲, {4:.3f}秒）".format(
+                counted, candidates,
+                len(winners), len(self.carried), perf_counter() - startedAt))
+        return winners
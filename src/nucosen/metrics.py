@@ -0,0 +1,237 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 関数・ホスト毎の所要時間、リトライ回数、再ログイン回数、エラーコードを集計し、
+#        Prometheusのテキスト形式で公開する
+#        METRICS_PORTを指定しない場合は集計自体を行わない
+
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from os import getcwd
+from re import match
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from decouple import AutoConfig
+from requests.exceptions import HTTPError
+
+config = AutoConfig(getcwd())
+
+port = int(config("METRICS_PORT", default=0))
+host = str(config("METRICS_HOST", default="127.0.0.1"))
+enabled = port > 0
+
+Buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts: List[int] = [0] * len(Buckets)
+        self.total: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(Buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry(object):
+    def __init__(self):
+        self.__lock = Lock()
+        self.__counters: Dict[str, Dict[Labels, float]] = {}
+        self.__gauges: Dict[str, Dict[Labels, float]] = {}
+        self.__histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.__help: Dict[str, str] = {}
+
+    def describe(self, name: str, text: str):
+        self.__help[name] = text
+
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            series = self.__histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self.__lock:
+            for kind, family in (("counter", self.__counters),
+                                 ("gauge", self.__gauges)):
+                for name, series in sorted(family.items()):
+                    self.__header(lines, name, kind)
+                    for labels, value in sorted(series.items()):
+                        lines.append("{0}{1} {2}".format(
+                            name, formatLabels(labels), repr(float(value))))
+            for name, histograms in sorted(self.__histograms.items()):
+                self.__header(lines, name, "histogram")
+                for labels, histogram in sorted(histograms.items()):
+                    for bound, count in zip(Buckets, histogram.counts):
+                        lines.append("{0}_bucket{1} {2}".format(
+                            name, formatLabels(labels + (("le", repr(bound)),)), count))
+                    lines.append("{0}_bucket{1} {2}".format(
+                        name, formatLabels(labels + (("le", "+Inf"),)), histogram.count))
+                    lines.append("{0}_sum{1} {2}".format(
+                        name, formatLabels(labels), repr(histogram.total)))
+                    lines.append("{0}_count{1} {2}".format(
+                        name, formatLabels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def __header(self, lines: List[str], name: str, kind: str):
+        if name in self.__help:
+            lines.append("# HELP {0} {1}".format(name, self.__help[name]))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+
+
+def formatLabels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append("{0}=\"{1}\"".format(key, value))
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = Registry()
+registry.describe("nucosen_function_duration_seconds", "1回の呼び出しに要した時間")
+registry.describe("nucosen_http_request_duration_seconds", "ホスト毎の通信に要した時間")
+registry.describe("nucosen_http_responses_total", "ホスト毎の応答ステータス")
+registry.describe("nucosen_retries_total", "リトライ回数")
+registry.describe("nucosen_relogins_total", "再ログイン回数（Lxxコード毎）")
+registry.describe("nucosen_errors_total", "関数毎のエラー回数（エラーコード毎）")
+registry.describe("nucosen_airtime_utilization_ratio", "直前の枠で動画を放送していた時間の割合")
+registry.describe("nucosen_airtime_seconds_total", "枠の時間と、そのうち動画を放送していた時間")
+
+
+def errorCode(error: BaseException) -> str:
+    # NOTE - "L01 ログインセッション更新"のようなメッセージからコードを取り出す
+    found = match(r"^([A-Z][0-9A-Z]{2}) ", str(error))
+    if found is not None:
+        return found.group(1)
+    if isinstance(error, HTTPError) and error.response is not None:
+        return str(error.response.status_code)
+    return type(error).__name__
+
+
+def timed(name: str) -> Callable:
+    # NOTE - 無効時は関数をそのまま返すため、呼び出しの負荷は増えない
+    def decorator(function: Callable) -> Callable:
+        if not enabled:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            startedAt = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                code = errorCode(e)
+                registry.increment("nucosen_errors_total", function=name, code=code)
+                if type(e).__name__ == "ReLoggedIn":
+                    registry.increment("nucosen_relogins_total", code=code)
+                raise
+            finally:
+                registry.observe(
+                    "nucosen_function_duration_seconds",
+                    perf_counter() - startedAt, function=name)
+        return wrapper
+    return decorator
+
+
+def observeHttp(hostName: str, method: str, seconds: float, status: Optional[int]):
+    registry.observe(
+        "nucosen_http_request_duration_seconds", seconds,
+        host=hostName, method=method)
+    registry.increment(
+        "nucosen_http_responses_total",
+        host=hostName, status="error" if status is None else str(status))
+
+
+def observeAirtime(airedSeconds: float, slotSeconds: float):
+    if not enabled or slotSeconds <= 0:
+        return
+    registry.set("nucosen_airtime_utilization_ratio", airedSeconds / slotSeconds)
+    registry.increment("nucosen_airtime_seconds_total", airedSeconds, kind="aired")
+    registry.increment("nucosen_airtime_seconds_total", slotSeconds, kind="slot")
+
+
+class RetryLogger(object):
+    # NOTE - retryPolicy.retryデコレーターに渡すロガー。リトライの度に回数を数える
+    def __init__(self, name: str):
+        self.name = name
+        self.__logger = getLogger(name)
+
+    def warning(self, msg, *args, **kwargs):
+        if enabled:
+            registry.increment("nucosen_retries_total", function=self.name)
+        # NOTE - ログの関数名がリトライ処理側（retryPolicy.retryCall）になるようにする
+        kwargs.setdefault("stacklevel", 2)
+        self.__logger.warning(msg, *args, **kwargs)
+
+
+def retryLogger(name: str) -> RetryLogger:
+    return RetryLogger(name)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+server: Optional[ThreadingHTTPServer] = None
+
+
+def startServer():
+    global server
+    if not enabled or server is not None:
+        return
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    Thread(target=server.serve_forever, name="nucosen-metrics", daemon=True).start()
+    getLogger(__name__).info("メトリクスを公開しました http://{0}:{1}/metrics".format(host, port))
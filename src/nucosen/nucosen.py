@@ -18,153 +18,301 @@ along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import sys
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta
 from logging import getLogger
-from os import getcwd
 from traceback import format_exc
+from typing import Callable, List, Optional
 
-from decouple import AutoConfig
+from nucosen import (checkpoint, clock, db, engines, httpClient, live,
+                     packing, personality, prefetch, quote, retryPolicy,
+                     sessionCookie, settings)
 
-from nucosen import clock, db, live, personality, quote, sessionCookie
+
+def prepareNext(database: db.QueueStorage, session: sessionCookie.Session,
+                conf: settings.Settings) -> prefetch.Prefetched:
+    # NOTE - 次に引用する動画を選出し、引用可能性・動画長を確認する
+    #        キューから選んだ動画は、引用を開始するまでキューから取り除かない
+    logger = getLogger(__name__)
+    items = database.peek(1)
+    if len(items) < 1:
+        logger.debug("キューが空なので補充を行います")
+        winners = personality.choiceFromRequests(
+            database.iterAndResetRequests(), 5)
+        if winners is not None:
+            database.enqueueByList(winners)
+            items = database.peek(1)
+    if len(items) > 0:
+        nextVideoId, itemId = items[0].videoId, items[0].itemId
+    else:
+        nextVideoId = personality.randomSelection(list(conf.reqTags), session, conf.ngTags)
+        itemId = None
+    videoInfo = quote.getVideoInfo(nextVideoId, session, conf.ngTags)
+    return prefetch.Prefetched(nextVideoId, videoInfo, itemId)
+
+
+def recoverFromOutage(prefetcher: prefetch.Prefetcher, liveId: Optional[str], videoId: str,
+                      session: sessionCookie.Session):
+    # NOTE - 通信障害時の後始末。先読みを取りやめ、可能であればメンテナンス動画を流す
+    #        枠の確認中（liveIdがNone）の場合は、メンテナンス動画を流さない
+    #        いずれかに失敗しても放送ループは止めない
+    steps: List[Callable[[], None]] = [prefetcher.cancel]
+    if liveId is not None:
+        steps.append(lambda: quote.loop(liveId, videoId, session))
+    with retryPolicy.deadline(clock.monotonic() + retryPolicy.circuitCooldown):
+        for step in steps:
+            try:
+                step()
+            except Exception as e:
+                getLogger(__name__).warning(
+                    "W52 通信障害時の後始末に失敗しました {0}".format(e))
+
+
+def releaseResources(prefetcher: Optional[prefetch.Prefetcher],
+                     session: Optional[sessionCookie.Session],
+                     database: Optional[db.QueueStorage]):
+    # NOTE - 放送ループの終了時に、先読み・再ログイン・キュー項目の削除のスレッドを止める
+    #        再起動時（複数チャンネルの同時運用時）に、前回のものが残って重複しないようにする
+    steps: List[Callable[[], None]] = []
+    if prefetcher is not None:
+        steps.append(prefetcher.cancel)
+    if session is not None:
+        steps.append(session.close)
+    if database is not None:
+        steps.append(database.close)
+    for step in steps:
+        try:
+            step()
+        except Exception as e:
+            getLogger(__name__).warning(
+                "W53 放送ループの終了時の後始末に失敗しました {0}".format(e))
 
 
-def run():
+async def waitForTransition(engine: engines.Engine, scheduler: clock.Scheduler,
+                            videoEnd: float) -> float:
+    # NOTE - 引用終了見込み時刻（monotonic）の少し前まで待機し、切り替えの開始時刻を返す
+    lead = scheduler.lead("transition")
+    await engine.call(scheduler.wait, videoEnd - lead)
+    getLogger(__name__).info("引用終了見込み時刻の{0:.2f}秒前になりました".format(lead))
+    return clock.monotonic()
+
+
+def run(scheduler: Optional[clock.Scheduler] = None,
+        engine: Optional[engines.Engine] = None):
+    # NOTE - schedulerを指定すると、その待機を使用する（複数チャンネルの同時運用時）
+    #        engineを指定しない場合は、呼び出し元のスレッドで全て実行する
+    engine = engine or engines.BlockingEngine()
+    engine.run(broadcast(engine, scheduler or clock.scheduler))
+
+
+async def broadcast(engine: engines.Engine, scheduler: clock.Scheduler):
+    # NOTE - 放送ループ。通信・待機はengine.callを通して行い、どちらのエンジンでも同じ制御を行う
+    #        シグナルハンドラーはメインスレッドで登録する必要があるため、engine.callを通さない
     logger = getLogger(__name__)
+    database: Optional[db.QueueStorage] = None
+    session: Optional[sessionCookie.Session] = None
+    prefetcher: Optional[prefetch.Prefetcher] = None
 
     try:
-        database = db.RestDbIo()
-        configLoader = AutoConfig(getcwd())
-
-        def config(key): return str(configLoader(key, default=""))
-        logininfo = config("NICO_ID"), config("NICO_PW"), config("NICO_TFA")
+        database = await engine.call(db.openStorage)
+        checkpoints = checkpoint.openStore()
+        settings.installReloadHandler()
+        conf = settings.current()
+        logininfo = conf.loginInfo
         if "" in logininfo:
             getLogger(__name__).info("現在のログイン情報: {0}".format(str(logininfo)))
             raise Exception("V00 ログイン情報が不十分です。現在の情報はinfoに出力済み。")
 
-        SPECIFIC_VIDEO_IDS = [
-            (config("MAINTENANCE_VIDEO_ID") or "sm17759202"),
-            (config("CLOSING_VIDEO_ID") or "sm17572946")
-        ]
-        MAINTENANCE, CLOSING = 0, 1
-
         session = sessionCookie.Session(*logininfo)
-        session.login()
+        await engine.call(session.resume)
+        session.startRefresher()
         logger.debug("チャンネルループ開始")
 
-        ngTags = set(config("NG_TAGS").split(","))
+        personality.startReservoir(list(conf.reqTags), session)
+
+        def prepareWithCurrentSettings() -> prefetch.Prefetched:
+            settings.reloadIfRequested()
+            return prepareNext(database, session, settings.current())
+
+        # NOTE - 優先エンキューの確認済みの目印を引き継ぐため、枠をまたいで同じものを使う
+        prefetcher = prefetch.Prefetcher(
+            prepareWithCurrentSettings,
+            database.priorityMarker, database.priorityMarkerAfter)
+
+        clock.installSignalHandlers(scheduler)
 
         while True:
-            logger.debug("現枠・次枠の確保開始")
-            liveIDs = live.getLives(session)
-            if liveIDs[0] is None:
-                if liveIDs[1] is None:
-                    logger.warning("W0L 枠未検出")
-                    live.reserveLive(
-                        title=config("LIVE_TITLE"),
-                        communityId=config("COMMUNITY"),
-                        tags=config("TAGS").split(","),
-                        session=session
-                    )
-                    liveIDs = live.getLives(session)
-                nextLive: str | None = liveIDs[0] or liveIDs[1]
-                if nextLive is None:
-                    raise Exception("V10 予約確認エラー")
-                nextLiveBegin = live.getStartTime(nextLive, session)
-                clock.waitUntil(nextLiveBegin)
-                liveIDs = live.getLives(session)
-            elif liveIDs[1] is None:
-                live.reserveLive(
-                    title=config("LIVE_TITLE"),
-                    communityId=config("COMMUNITY"),
-                    tags=config("TAGS").split(","),
-                    session=session
-                )
-            liveIDs = live.sGetLives(session)
-            logger.info("現枠: {0}, 次枠: {1}".format(liveIDs[0], liveIDs[1]))
-
-            logger.debug("現存する引用状態の処理")
-            currentLiveEnd = live.getEndTime(liveIDs[0], session)
-            currentQuote = quote.getCurrent(liveIDs[0], session)
-            if currentQuote is not None:
-                if currentQuote == SPECIFIC_VIDEO_IDS[MAINTENANCE]:
-                    logger.info("メンテナンス動画の引用を検知しました")
-                    quote.stop(liveIDs[0], session)
-                    quote.once(
-                        liveIDs[0], SPECIFIC_VIDEO_IDS[MAINTENANCE], session)
-                elif currentQuote == SPECIFIC_VIDEO_IDS[CLOSING]:
-                    logger.info("エンディング動画の引用を検知しました")
-                    nextLiveBegin = live.getStartTime(liveIDs[1], session)
-                    clock.waitUntil(currentLiveEnd)
-                    live.reserveLive(
-                        title=config("LIVE_TITLE"),
-                        communityId=config("COMMUNITY"),
-                        tags=config("TAGS").split(","),
+            # NOTE - 設定の再読み込みは枠の確認からやり直す時点で反映する
+            #        動画の選出は先読みの度に最新の設定を使用する
+            settings.reloadIfRequested()
+            conf = settings.current()
+            retryMargin = timedelta(seconds=conf.retryDeadlineMargin)
+            # NOTE - 枠の確認中の通信障害も、放送中と同じく中断して一定時間後にやり直す
+            currentLiveId: Optional[str] = None
+            try:
+                logger.debug("現枠・次枠の確保開始")
+                liveIDs = await engine.call(live.getLives, session)
+                if liveIDs[0] is None:
+                    if liveIDs[1] is None:
+                        logger.warning("W0L 枠未検出")
+                        await engine.call(
+                            live.reserveLive,
+                            title=conf.liveTitle,
+                            communityId=conf.communityId,
+                            tags=list(conf.tags),
+                            session=session
+                        )
+                        liveIDs = await engine.call(live.getLives, session)
+                    nextLive: str | None = liveIDs[0] or liveIDs[1]
+                    if nextLive is None:
+                        raise Exception("V10 予約確認エラー")
+                    nextLiveBegin = await engine.call(live.getStartTime, nextLive, session)
+                    await engine.call(scheduler.waitUntil, nextLiveBegin)
+                    live.invalidateProgramState()
+                    liveIDs = await engine.call(live.getLives, session)
+                elif liveIDs[1] is None:
+                    await engine.call(
+                        live.reserveLive,
+                        title=conf.liveTitle,
+                        communityId=conf.communityId,
+                        tags=list(conf.tags),
                         session=session
                     )
-                    clock.waitUntil(nextLiveBegin)
-                    liveIDs = live.sGetLives(session)
-                else:
-                    logger.info("一般動画の引用を検知しました: {0}".format(currentQuote))
-                    quote.stop(liveIDs[0], session)
-                    maintenanceSpan = quote.once(
-                        liveIDs[0], SPECIFIC_VIDEO_IDS[MAINTENANCE], session)
-                    maintenanceEnd = datetime.now(
-                        timezone.utc) + maintenanceSpan
-                    logger.error("E30 引用停止 {0}".format(currentQuote))
-                    emergencyStopMessage = \
-                        str(config("NUCOSEN_MAINTENANCE_MESSAGE"))\
-                        or "システムが異常停止したため、自動回復機能により復旧しました。\n" +\
-                        "ご迷惑をおかけし大変申し訳ございません。まもなく再開いたします。"
-                    live.showMessage(
-                        liveIDs[0], emergencyStopMessage, session)
-                    clock.waitUntil(maintenanceEnd)
-
-            currentLiveId = live.sGetLives(session)[0]
-            logger.info("放送の準備が整いました: {0}".format(currentLiveId))
-            while True:
-
-                nextVideoId = database.dequeue()
-                if nextVideoId is None:
-                    logger.debug("キューが空なので補充を行います")
-                    requests = database.getAndResetRequests()
-                    if requests is not None:
-                        winners = personality.choiceFromRequests(requests, 5)
-                        if winners is None:
-                            logger.error("E40 抽選アボート {0}".format(requests))
-                            selection = personality.randomSelection(
-                                config("REQTAGS").split(","), session, ngTags)
-                        else:
-                            selection = winners.pop()
-                            database.enqueueByList(winners)
+                liveIDs = await engine.call(live.sGetLives, session)
+                logger.info("現枠: {0}, 次枠: {1}".format(liveIDs[0], liveIDs[1]))
+
+                logger.debug("現存する引用状態の処理")
+                currentLiveEnd = await engine.call(live.getEndTime, liveIDs[0], session)
+                currentQuote = await engine.call(quote.getCurrent, liveIDs[0], session)
+                # NOTE - 異常終了前に引用を開始した動画がそのまま流れていれば、止めずに終了を待つ
+                resumed = await engine.call(checkpoints.matches, liveIDs[0], currentQuote)
+                if resumed is not None:
+                    logger.info("チェックポイントから再開します: {0} (残り{1:.0f}秒)".format(
+                        resumed.videoId, resumed.endsAt - clock.timestamp()))
+                elif currentQuote is not None:
+                    if currentQuote == conf.maintenanceVideoId:
+                        logger.info("メンテナンス動画の引用を検知しました")
+                        await engine.call(quote.stop, liveIDs[0], session)
+                        await engine.call(
+                            quote.once, liveIDs[0], conf.maintenanceVideoId, session)
+                    elif currentQuote == conf.closingVideoId:
+                        logger.info("エンディング動画の引用を検知しました")
+                        nextLiveBegin = await engine.call(live.getStartTime, liveIDs[1], session)
+                        await engine.call(scheduler.waitUntil, currentLiveEnd)
+                        await engine.call(
+                            live.reserveLive,
+                            title=conf.liveTitle,
+                            communityId=conf.communityId,
+                            tags=list(conf.tags),
+                            session=session
+                        )
+                        await engine.call(scheduler.waitUntil, nextLiveBegin)
+                        live.invalidateProgramState()
+                        liveIDs = await engine.call(live.sGetLives, session)
                     else:
-                        selection = personality.randomSelection(
-                            config("REQTAGS").split(","), session, ngTags)
-                    nextVideoId = selection
-
-                logger.info("引用を開始します: {0}".format(nextVideoId))
-                currentLiveEnd = live.getEndTime(currentLiveId, session)
-                videoInfo = quote.getVideoInfo(nextVideoId, session, ngTags)
-                if videoInfo[0] is False:
-                    raise Exception("V20 引用不能エラー {0} {1}".format(
-                        nextVideoId, currentLiveId))
-                if datetime.now(timezone.utc) + videoInfo[1] > currentLiveEnd - timedelta(minutes=1):
-                    logger.info("引用アボート: 時間内に引用が終了しない見込みです")
-                    database.priorityEnqueue(nextVideoId)
-                    quote.loop(
-                        currentLiveId, SPECIFIC_VIDEO_IDS[CLOSING], session)
-                    live.showMessage(
-                        currentLiveId,
-                        config("NUCOSEN_CLOSING_MESSAGE") or
-                        "この枠の放送は終了しました。\nご視聴ありがとうございました。",
-                        session, permanent=True)
-                    clock.waitUntil(currentLiveEnd)
-                    break
-                quote.once(currentLiveId, nextVideoId, session)
-                live.showMessage(currentLiveId, videoInfo[2], session)
-                clock.waitUntil(datetime.now(timezone.utc) + videoInfo[1])
-                logger.info("引用終了見込み時刻になりました")
+                        logger.info("一般動画の引用を検知しました: {0}".format(currentQuote))
+                        await engine.call(quote.stop, liveIDs[0], session)
+                        maintenanceSpan = await engine.call(
+                            quote.once, liveIDs[0], conf.maintenanceVideoId, session)
+                        maintenanceEnd = clock.now() + maintenanceSpan
+                        logger.error("E30 引用停止 {0}".format(currentQuote))
+                        await engine.call(
+                            live.showMessage, liveIDs[0], conf.maintenanceMessage, session)
+                        await engine.call(scheduler.waitUntil, maintenanceEnd)
+
+                currentLiveId = (await engine.call(live.sGetLives, session))[0]
+                logger.info("放送の準備が整いました: {0}".format(currentLiveId))
+                # NOTE - 次の動画の準備（先読みの受け取り・枠の終了時刻の確認・穴埋め）の所要時間を計測し、
+                #        次回以降はその分だけ早く準備を始める
+                #        quote.onceは前の動画の停止から始まるため、引用は前の動画の終了見込み時刻まで待つ
+                #        （先取り時間の分だけ早く引用すると、その分だけ前の動画の終わりが切れる）
+                transitionStartedAt: Optional[float] = None
+                videoEnd: Optional[float] = None
+                # NOTE - 枠の稼働率（動画を放送していた時間の割合）の計測
+                slotStartedAt = clock.now()
+                airedSeconds = 0.0
+                slotEnd = await engine.call(live.getEndTime, currentLiveId, session)
+                with retryPolicy.deadlineAt(slotEnd - retryMargin):
+                    if resumed is not None:
+                        airedSeconds += resumed.endsAt - clock.timestamp()
+                        prefetcher.start()
+                        videoEnd = clock.monotonic() + resumed.endsAt - clock.timestamp()
+                        transitionStartedAt = await waitForTransition(
+                            engine, scheduler, videoEnd)
+                    while True:
+
+                        prepared = await engine.call(prefetcher.take, videoEnd)
+                        nextVideoId, videoInfo = prepared.videoId, prepared.videoInfo
+
+                        logger.info("引用を開始します: {0}".format(nextVideoId))
+                        currentLiveEnd = await engine.call(live.getEndTime, currentLiveId, session)
+                        if videoInfo[0] is False:
+                            raise Exception("V20 引用不能エラー {0} {1}".format(
+                                nextVideoId, currentLiveId))
+                        remaining = currentLiveEnd - timedelta(minutes=1) - clock.now()
+                        if videoInfo[1] > remaining:
+                            # NOTE - 収まらない動画はキューに残り、次の枠で最初に放送される
+                            logger.info("引用アボート: 時間内に引用が終了しない見込みです")
+                            packed = await engine.call(
+                                packing.packRemaining,
+                                database, session, currentLiveEnd - timedelta(minutes=1))
+                            if packed is not None:
+                                prepared = packed
+                                nextVideoId, videoInfo = packed.videoId, packed.videoInfo
+                        if transitionStartedAt is not None:
+                            scheduler.observe(
+                                "transition", clock.monotonic() - transitionStartedAt)
+                        if videoEnd is not None:
+                            await engine.call(scheduler.wait, videoEnd)
+                        if videoInfo[1] > remaining:
+                            await engine.call(checkpoints.clear)
+                            await engine.call(
+                                quote.loop, currentLiveId, conf.closingVideoId, session)
+                            await engine.call(
+                                live.showMessage,
+                                currentLiveId,
+                                conf.closingMessage,
+                                session, permanent=True)
+                            await engine.call(scheduler.waitUntil, currentLiveEnd)
+                            break
+                        if prepared.itemId is not None:
+                            await engine.call(database.remove, prepared.itemId)
+                        await engine.call(
+                            quote.once, currentLiveId, nextVideoId, session, videoInfo[1])
+                        quoteStartedAt = clock.monotonic()
+                        await engine.call(
+                            checkpoints.record, currentLiveId, nextVideoId,
+                            clock.timestamp(), clock.timestamp() + videoInfo[1].total_seconds())
+                        airedSeconds += videoInfo[1].total_seconds()
+                        videoEnd = quoteStartedAt + videoInfo[1].total_seconds()
+                        await engine.call(
+                            live.showMessage, currentLiveId, videoInfo[2], session)
+                        prefetcher.start()
+                        transitionStartedAt = await waitForTransition(
+                            engine, scheduler, videoEnd)
+            except (retryPolicy.CircuitOpen, retryPolicy.DeadlineExceeded) as e:
+                # NOTE - 通信障害時はリトライで待ち続けず、メンテナンス動画に切り替えて
+                #        一定時間後に枠の確認からやり直す
+                logger.error("E50 通信障害のため放送を中断します {0}".format(e))
+                await engine.call(
+                    recoverFromOutage,
+                    prefetcher, currentLiveId, conf.maintenanceVideoId, session)
+                await engine.call(
+                    scheduler.wait, clock.monotonic() + retryPolicy.circuitCooldown)
+                live.invalidateProgramState()
+                continue
             logger.info("放送が終了しました: {0}".format(currentLiveId))
+            await engine.call(checkpoints.clear)
+            packing.reportAirtime(
+                currentLiveId, airedSeconds,
+                (currentLiveEnd - slotStartedAt).total_seconds())
+            live.invalidateProgramState()
+            httpClient.logPoolStats()
+            quote.logCacheStats()
+    except clock.ShutdownRequested:
+        logger.info("終了要求により放送を停止しました")
     except Exception:
         t = format_exc()
         logger.critical("例外がキャッチされませんでした\n```\n{0}\n```".format(t))
         sys.exit(0)
+    finally:
+        await engine.call(releaseResources, prefetcher, session, database)
@@ -0,0 +1,112 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 枠の終了間際に、次の動画が残り時間に収まらない場合の穴埋め
+#        キューの先頭から順に → リクエストの抽選（キューが空の場合のみ） → ランダムセレクション の順で、
+#        残り時間に収まる動画を探す。収まる動画を流した後も時間が残れば、
+#        次の切り替えで再び穴埋めを行うため、短い動画が続けて選ばれることもある
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from os import getcwd
+from typing import Optional, Tuple
+
+from decouple import AutoConfig
+
+from nucosen import metrics, personality, quote, retryPolicy, settings
+from nucosen.clock import monotonic, now
+from nucosen.db import QueueStorage
+from nucosen.prefetch import Prefetched
+from nucosen.sessionCookie import Session
+
+config = AutoConfig(getcwd())
+# NOTE - 穴埋めの候補として調べるキューの先頭からの件数（0で穴埋めしない）
+lookahead = int(config("PACKING_LOOKAHEAD", default=20))
+requestChoices = 5
+
+
+def fits(videoInfo: Tuple[bool, timedelta, str], remaining: timedelta) -> bool:
+    return videoInfo[0] is True and videoInfo[1] <= remaining
+
+
+@metrics.timed(__name__ + ".packRemaining")
+def packRemaining(database: QueueStorage, session: Session,
+                  until: datetime) -> Optional[Prefetched]:
+    # NOTE - untilまでに終わる動画を探す。探している間にも残り時間は減るため、都度計算し直す
+    logger = getLogger(__name__)
+    conf = settings.current()
+    shortest = timedelta(seconds=conf.minAllowableDuration)
+
+    def remaining() -> timedelta:
+        return until - now()
+    if lookahead < 1 or remaining() < shortest:
+        return None
+
+    # NOTE - キューの順序をなるべく保つため、先頭に近いものを優先する
+    #        選んだ項目は、引用を開始する時に呼び出し側がキューから取り除く
+    queued = database.peek(lookahead)
+    for rank, item in enumerate(queued):
+        videoInfo = quote.getVideoInfo(item.videoId, session, conf.ngTags)
+        if fits(videoInfo, remaining()):
+            logger.info("穴埋め: キューの{0}件目 {1} ({2}秒)".format(
+                rank + 1, item.videoId, int(videoInfo[1].total_seconds())))
+            return Prefetched(item.videoId, videoInfo, item.itemId)
+
+    # NOTE - 抽選はリクエストを全て読み出して消費するため、通常の選出と同じくキューが空の場合のみ行う
+    winners = None if len(queued) > 0 else personality.choiceFromRequests(
+        database.iterAndResetRequests(), requestChoices)
+    if winners is not None:
+        # NOTE - 当選順に調べ、収まらなかった当選はいつも通りキューに積む
+        for videoId in winners:
+            videoInfo = quote.getVideoInfo(videoId, session, conf.ngTags)
+            if fits(videoInfo, remaining()):
+                database.enqueueByList(
+                    [winner for winner in winners if winner != videoId])
+                logger.info("穴埋め: リクエスト {0} ({1}秒)".format(
+                    videoId, int(videoInfo[1].total_seconds())))
+                return Prefetched(videoId, videoInfo)
+        database.enqueueByList(winners)
+
+    # NOTE - 最短の動画も収まらなくなる時点でリトライを打ち切る
+    #        この期限切れは通信障害として扱わず、穴埋めを諦める
+    try:
+        with retryPolicy.deadline(
+                monotonic() + (remaining() - shortest).total_seconds()):
+            videoId = personality.randomSelection(
+                list(conf.reqTags), session, conf.ngTags, maxDuration=remaining())
+    except (*personality.NetworkErrors, retryPolicy.DeadlineExceeded) as e:
+        logger.info("穴埋めできませんでした {0}".format(e))
+        return None
+    if videoId == conf.maintenanceVideoId:
+        return None
+    videoInfo = quote.getVideoInfo(videoId, session, conf.ngTags)
+    if not fits(videoInfo, remaining()):
+        return None
+    logger.info("穴埋め: ランダムセレクション {0} ({1}秒)".format(
+        videoId, int(videoInfo[1].total_seconds())))
+    return Prefetched(videoId, videoInfo)
+
+
+def reportAirtime(liveId: str, airedSeconds: float, slotSeconds: float):
+    # NOTE - 枠のうち動画を放送していた時間の割合（クロージング動画などは含まない）
+    if slotSeconds <= 0:
+        return
+    getLogger(__name__).info("放送枠の稼働率 {0}: {1:.1%} (動画 {2:.0f}秒 / 枠 {3:.0f}秒)".format(
+        liveId, airedSeconds / slotSeconds, airedSeconds, slotSeconds))
+    metrics.observeAirtime(airedSeconds, slotSeconds)
@@ -17,18 +17,24 @@ You should have received a copy of the GNU Affero General Public License
 along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import timedelta
 from logging import getLogger
 from random import randint, shuffle
-from typing import List, Optional
+from threading import Lock
+from time import monotonic
+from typing import Dict, FrozenSet, Iterable, List, Optional
 
-from requests import get
 from requests.exceptions import ConnectionError as ConnError
 from requests.exceptions import HTTPError
-from retry import retry
 from decouple import AutoConfig
 from os import getcwd
 
-from nucosen import quote
+from nucosen import lottery, metrics, quote, settings
+from nucosen.httpClient import get
+from nucosen.reservoir import CandidateReservoir
+from nucosen.retryPolicy import retry
 from nucosen.sessionCookie import Session
 
 
@@ -40,65 +46,173 @@ config = AutoConfig(getcwd())
 NetworkErrors = (HTTPError, ConnError, RetryRequested)
 UserAgent = str(config("NUCOSEN_UA_PREFIX", default="anonymous")
                 ) + " / NUCOSen Broadcast Personality System"
-
-
-def choiceFromRequests(requests: List[str], choicesNum: int) -> Optional[List[str]]:
-    shuffle(requests)
-    winner = list()
-    for request in requests:
-        if request in winner:
-            continue
-        winner.append(request)
-        if len(winner) >= choicesNum:
-            break
-    return winner if len(winner) else None
-
-
-@retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=getLogger(__name__ + ".randomSelection"))
-def randomSelection(tags: List[str], session: Session, ngTags: set) -> str:
-    _tags = tags.copy()
+# NOTE - ランダムセレクションで同時に審査する候補の数（1で逐次審査）
+selectionWorkers = int(config("SELECTION_WORKERS", default=4))
+
+
+# NOTE - チャンネル名（単独運用時はNone） -> リクエスト抽選
+#        落選した票の持ち越しは、複数チャンネルの同時運用時もチャンネル毎に行う
+requestLotteries: Dict[Optional[str], lottery.RequestLottery] = {}
+requestLotteriesLock = Lock()
+
+
+def requestLottery() -> lottery.RequestLottery:
+    channel = settings.channelVar.get()
+    name = None if channel is None else channel.name
+    with requestLotteriesLock:
+        found = requestLotteries.get(name)
+        if found is None:
+            found = requestLotteries[name] = lottery.RequestLottery()
+        return found
+
+
+@metrics.timed(__name__ + ".choiceFromRequests")
+def choiceFromRequests(requests: Iterable[lottery.BallotLike], choicesNum: int) -> Optional[List[str]]:
+    # NOTE - 票数に比例して当選しやすくなる抽選。当選順に返す
+    conf = settings.current()
+    ranked = requestLottery().draw(
+        requests, choicesNum, conf.requestCapPerRequester, conf.requestCarryOver)
+    if len(ranked) < 1:
+        return None
+    return ranked
+
+
+@metrics.timed(__name__ + ".searchCandidates")
+def searchCandidates(tag: str, offset: int, maxDuration: Optional[int] = None) -> Optional[List[str]]:
+    # NOTE - スナップショット検索で候補の動画IDを得る
+    #        スナップショット検索が停止している場合はNone
+    #        maxDurationを指定すると、設定より短い動画に絞り込む
     url = "https://snapshot.search.nicovideo.jp/api/v2/snapshot/video/contents/search"
     header = {
         "UserAgent": UserAgent
     }
-    shuffle(_tags)
-    tag = _tags.pop()
-    offset = randint(0, 90)
-    minimumAllowableDuration = \
-        int(config("MIN_ALLOWABLE_DURATION", default=45))
-    maximumAllowableDuration = \
-        int(config("MAX_ALLOWABLE_DURATION", default=10 * 60))
-    if maximumAllowableDuration < minimumAllowableDuration:
-        maximumAllowableDuration = minimumAllowableDuration + (10 * 60)
+    conf = settings.current()
     payload = {
         "q": tag,
         "targets": "tagsExact",
         "fields": "contentId",
-        "filters[lengthSeconds][gte]": minimumAllowableDuration,
-        "filters[lengthSeconds][lte]": maximumAllowableDuration,
+        "filters[lengthSeconds][gte]": conf.minAllowableDuration,
+        "filters[lengthSeconds][lte]": conf.maxAllowableDuration
+        if maxDuration is None else min(conf.maxAllowableDuration, maxDuration),
         "_sort": "-lastCommentTime",
         "_context": UserAgent,
         "_limit": "30",
         "_offset": offset
     }
 
-    ngVideos = str(config("NG_VIDEO_IDS",default="")).split(",")
+    ngVideos = conf.ngVideoIds
 
     response = get(url, headers=header, params=payload)
-    result = dict(response.json())
-    # スナップショット検索が死んでいるときはテレビちゃんを休ませる
     if response.status_code == 503:
-        return str(config("MAINTENANCE_VIDEO_ID", default="sm17759202"))
+        return None
+    result = dict(response.json())
     response.raise_for_status()
     winners: List[str] = []
     for target in result['data']:
         if not target["contentId"] in ngVideos:
             winners.append(target['contentId'])
+    return winners
+
+
+def getNgVideoIds() -> FrozenSet[str]:
+    return settings.current().ngVideoIds
+
+
+@retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".randomSelection"))
+@metrics.timed(__name__ + ".randomSelection")
+def randomSelection(tags: List[str], session: Session, ngTags: set,
+                    maxDuration: Optional[timedelta] = None) -> str:
+    # NOTE - maxDurationを指定すると、その長さ以下の動画のみ選出する（枠末尾の穴埋め用）
+    if reservoir is not None:
+        ngVideos = getNgVideoIds()
+
+        def accept(videoId: str) -> bool:
+            return videoId not in ngVideos and quote.checkNgTag(videoId, ngTags)
+        if maxDuration is None:
+            reserved = reservoir.draw(accept, tags)
+        else:
+            reserved = reservoir.drawFitting(
+                lambda videoId: quote.getVideoInfo(videoId, session, set())[1] <= maxDuration
+                and accept(videoId), tags)
+        if reserved is not None:
+            getLogger(__name__).info("リザーバーから選出 {0}".format(reserved))
+            return reserved
+    _tags = tags.copy()
+    shuffle(_tags)
+    tag = _tags.pop()
+    # NOTE - 長さで絞り込む場合は候補が少ないため、先頭から検索する
+    offset = randint(0, 90) if maxDuration is None else 0
+    winners = searchCandidates(
+        tag, offset, None if maxDuration is None else int(maxDuration.total_seconds()))
+    # スナップショット検索が死んでいるときはテレビちゃんを休ませる
+    if winners is None:
+        return settings.current().maintenanceVideoId
     shuffle(winners)
     if len(winners) == 0:
         raise RetryRequested("V30 セレクション失敗 {0} {1}".format(tag, offset))
-    for winner in winners:
-        if quote.getVideoInfo(winner, session, ngTags)[0] is True:
-            return winner
-        getLogger(__name__).info("セレクションリジェクト {0}".format(winner))
+    winner = vetCandidates(winners, session, ngTags)
+    if winner is not None:
+        return winner
     raise RetryRequested("V31 セレクション失敗 {0} {1}".format(tag, offset))
+
+
+reservoir: Optional[CandidateReservoir] = None
+
+
+reservoirLock = Lock()
+
+
+def startReservoir(tags: List[str], session: Session):
+    # NOTE - RESERVOIR_HIGHが0の場合はリザーバーを使用しない
+    #        複数チャンネルの同時運用時は1つのリザーバーを共有し、各チャンネルのタグを加える
+    global reservoir
+    highWatermark = int(config("RESERVOIR_HIGH", default=6))
+    if highWatermark < 1:
+        return
+    with reservoirLock:
+        if reservoir is not None:
+            reservoir.addTags(tags)
+            return
+        reservoir = CandidateReservoir(
+            tags,
+            search=lambda tag: searchCandidates(tag, randint(0, 90)),
+            vet=lambda videoId: vetReserved(videoId, session),
+            lowWatermark=int(config("RESERVOIR_LOW", default=2)),
+            highWatermark=highWatermark,
+            ttl=float(config("RESERVOIR_TTL", default=60 * 60))
+        )
+        reservoir.start()
+
+
+def vetReserved(videoId: str, session: Session) -> bool:
+    # NOTE - NGタグは取り出す時点の設定で判定するため、ここではタグの取得のみ行い、
+    #        取り出し時の判定がキャッシュで済むようにする
+    if quote.getVideoInfo(videoId, session, set())[0] is not True:
+        return False
+    quote.getVideoTags(videoId)
+    return True
+
+
+def vetCandidates(candidates: List[str], session: Session, ngTags: set) -> Optional[str]:
+    # NOTE - 候補を並列で審査し、候補の順序で最初の引用可能な動画を返す
+    #        当選が決まった時点で、未着手の審査は取り消す
+    logger = getLogger(__name__)
+    startedAt = monotonic()
+    workers = max(1, min(selectionWorkers, len(candidates)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # NOTE - リトライの期限やチャンネル毎の設定などのコンテキストを、審査毎に複製して引き継ぐ
+        futures = [
+            executor.submit(copy_context().run,
+                            quote.getVideoInfo, candidate, session, ngTags)
+            for candidate in candidates
+        ]
+        for rank, (candidate, future) in enumerate(zip(candidates, futures)):
+            if future.result()[0] is True:
+                logger.info("セレクション当選 {0} ({1}件目, {2:.2f}秒)".format(
+                    candidate, rank + 1, monotonic() - startedAt))
+                return candidate
+            logger.info("セレクションリジェクト {0}".format(candidate))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None
@@ -0,0 +1,130 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from contextvars import copy_context
+from datetime import timedelta
+from logging import getLogger
+from threading import Thread
+from time import monotonic
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from nucosen import retryPolicy
+
+
+class Prefetched(NamedTuple):
+    videoId: str
+    # NOTE - quote.getVideoInfoの戻り値 (引用可能性, 動画長, 紹介メッセージ)
+    videoInfo: Tuple[bool, timedelta, str]
+    # NOTE - キューから選んだ動画の項目ID。引用を開始する時にキューから取り除く
+    #        それまではキューに残るため、破棄や異常終了で動画が失われず、キューの順序も変わらない
+    itemId: Optional[str] = None
+
+
+class Prefetcher(object):
+    # NOTE - 放送中に次の動画の選出・審査を済ませておく
+    #        先読みの開始後に優先エンキューがあった場合は、
+    #        受け取り時に先読みした動画を破棄してその場で選出し直す
+    #        確認済みの目印（最新の優先項目のID）は次の先読みに引き継ぎ、
+    #        確認と次の先読みの開始の間や、確認できなかった間の優先エンキューも見逃さない
+    #        受け取りは前の動画の終了見込み時刻の先取り時間前に行うため、
+    #        優先エンキューの確認（通信）は切り替えの準備時間に含まれ、前の動画の終わりを切らない
+    def __init__(
+        self,
+        prepare: Callable[[], Prefetched],
+        marker: Callable[[], str],
+        markerAfter: Callable[[str], Optional[str]]
+    ):
+        self.__prepare = prepare
+        self.__marker = marker
+        self.__markerAfter = markerAfter
+        self.__thread: Optional[Thread] = None
+        self.__knownMarker: Optional[str] = None
+        self.__result: Optional[Prefetched] = None
+        self.__error: Optional[BaseException] = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__result = None
+        self.__error = None
+        # NOTE - リトライの期限などのコンテキストを引き継ぐ
+        self.__thread = Thread(
+            target=copy_context().run, args=(self.__run,),
+            name="nucosen-prefetch", daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        startedAt = monotonic()
+        try:
+            # NOTE - 選出より先に取得し、選出中の優先エンキューも破棄判定の対象にする
+            if self.__knownMarker is None:
+                self.__knownMarker = self.__marker()
+            self.__result = self.__prepare()
+            getLogger(__name__).info("先読み完了 {0} ({1:.2f}秒)".format(
+                self.__result.videoId, monotonic() - startedAt))
+        except BaseException as e:
+            self.__error = e
+
+    def cancel(self):
+        # NOTE - 先読みを取りやめる。先読みした動画はキューに残っている
+        if self.__thread is None:
+            return
+        self.__thread.join()
+        self.__thread = None
+        self.__result = None
+        self.__error = None
+
+    def take(self, checkDeadline: Optional[float] = None) -> Prefetched:
+        # NOTE - checkDeadline（monotonic）までに優先エンキューを確認できない場合は、
+        #        先読みした動画をそのまま使い、切り替えを遅らせない
+        if self.__thread is None:
+            # NOTE - 先読みしていない場合も、確認済みの目印があれば優先エンキューを確認して取り出せるようにする
+            if self.__knownMarker is not None:
+                self.__priorityChanged(checkDeadline)
+            return self.__prepare()
+        self.__thread.join()
+        self.__thread = None
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise error
+        result, self.__result = self.__result, None
+        if result is None:
+            return self.__prepare()
+        if self.__priorityChanged(checkDeadline):
+            getLogger(__name__).info(
+                "優先キューが更新されたため先読みを破棄します {0}".format(result.videoId))
+            return self.__prepare()
+        return result
+
+    def __priorityChanged(self, checkDeadline: Optional[float]) -> bool:
+        known = self.__knownMarker or ""
+        try:
+            if checkDeadline is None:
+                newer = self.__markerAfter(known)
+            else:
+                with retryPolicy.deadline(checkDeadline):
+                    newer = self.__markerAfter(known)
+        except Exception as e:
+            getLogger(__name__).warning(
+                "W05 優先キューの更新を確認できないため、先読みした動画を使用します {0}".format(e))
+            return False
+        if newer is None:
+            return False
+        self.__knownMarker = newer
+        return True
@@ -17,18 +17,22 @@ You should have received a copy of the GNU Affero General Public License
 along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from decouple import AutoConfig
 from os import getcwd
 from datetime import timedelta
 from logging import getLogger
-from typing import Optional, Tuple, Dict, Any
-from time import sleep
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
 
-from requests import delete, get, post, patch
 from requests.exceptions import ConnectionError as ConnError
 from requests.exceptions import HTTPError
-from retry import retry
 
+from nucosen import metrics, settings
+from nucosen.cache import TtlLruCache
+from nucosen.clock import sleep
+from nucosen.httpClient import delete, get, patch, post
+from nucosen.retryPolicy import retry
 from nucosen.sessionCookie import Session
 
 from defusedxml import ElementTree as ET
@@ -63,7 +67,8 @@ quoteBotUri = \
     if config("USE_OLD_QUOTE_BOT",default=False) else \
     "https://lapi.spi.nicovideo.jp/v1/tools/live/contents/{0}/quotation"
 
-@retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=getLogger(__name__ + ".getCurrent"))
+@retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".getCurrent"))
+@metrics.timed(__name__ + ".getCurrent")
 def getCurrent(liveId: str, session: Session) -> Optional[str]:
     url = quoteBotUri
     resp = get(url.format(liveId), cookies=session.cookie)
@@ -78,7 +83,8 @@ def getCurrent(liveId: str, session: Session) -> Optional[str]:
     return quotationContent
 
 
-@retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=getLogger(__name__ + ".stop"))
+@retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".stop"))
+@metrics.timed(__name__ + ".stop")
 def stop(liveId: str, session: Session):
     url = quoteBotUri
     resp = delete(url.format(liveId), cookies=session.cookie)
@@ -91,41 +97,99 @@ def stop(liveId: str, session: Session):
     resp.raise_for_status()
 
 
-@retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=getLogger(__name__ + ".checkNgTag"))
-def checkNgTag(videoId: str, ngTags: set) -> bool:
-    url = "https://ext.nicovideo.jp/api/getthumbinfo/{0}"
-    resp = get(url.format(videoId))
-    resp.raise_for_status()
-    videoThumbInfo = ET.fromstring(resp.text)
-    tagsElement = videoThumbInfo.findall(".//tag")
-    tags = set(map(lambda x: x.text, tagsElement))
-    return True if len(ngTags & tags) == 0 else False
+# NOTE - 動画ID -> タグの一覧
+videoTagsCache = TtlLruCache(
+    int(config("TAG_CACHE_SIZE", default=4096)),
+    config("TAG_CACHE_PATH", default=None)
+)
+videoTagsTtl = float(config("TAG_CACHE_TTL", default=24 * 60 * 60))
+ngTagWorkers = int(config("NG_TAG_WORKERS", default=4))
 
 
-def boolConfig(key, default):
-    return bool(AutoConfig(getcwd())(key, default))
+@retry(NetworkErrors, tries=5, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".fetchVideoTags"))
+@metrics.timed(__name__ + ".fetchVideoTags")
+def fetchVideoTags(videoId: str) -> List[str]:
+    url = "https://ext.nicovideo.jp/api/getthumbinfo/{0}"
+    resp = get(url.format(videoId), stream=True)
+    try:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        tags: List[str] = []
+        # NOTE : tags要素を読み終えた時点で解析を打ち切る
+        for _, element in ET.iterparse(resp.raw, events=("end",)):
+            if element.tag == "tag" and element.text is not None:
+                tags.append(element.text)
+            elif element.tag == "tags":
+                break
+        # NOTE : 残りは僅かなので読み捨てて接続を再利用する
+        resp.raw.drain_conn()
+    finally:
+        resp.close()
+    return tags
+
+
+def getVideoTags(videoId: str) -> FrozenSet[str]:
+    cached = videoTagsCache.get(videoId)
+    if cached is None:
+        cached = fetchVideoTags(videoId)
+        videoTagsCache.put(videoId, cached, videoTagsTtl)
+    return frozenset(cached)
 
 
-@retry(NetworkErrors, tries=3, delay=1, backoff=2, logger=getLogger(__name__ + ".getVideoInfo"))
-def getVideoInfo(videoId: str, session: Session, ngTags: set) -> Tuple[bool, timedelta, str]:
-    # NOTE - 戻り値: (引用可能性, 動画長, 紹介メッセージ)
+def checkNgTag(videoId: str, ngTags: set) -> bool:
+    if len(ngTags) == 0:
+        return True
+    return True if len(ngTags & getVideoTags(videoId)) == 0 else False
+
+
+def checkNgTags(videoIds: Iterable[str], ngTags: set) -> Dict[str, bool]:
+    # NOTE - キャッシュに無い動画のタグのみ並列で取得する
+    videoIds = list(dict.fromkeys(videoIds))
+    if len(ngTags) == 0:
+        return {videoId: True for videoId in videoIds}
+    uncached = [videoId for videoId in videoIds
+                if not videoTagsCache.contains(videoId)]
+    if len(uncached) > 0:
+        workers = max(1, min(ngTagWorkers, len(uncached)))
+        # NOTE - リトライの期限やチャンネル毎の設定などのコンテキストを、取得毎に複製して引き継ぐ
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(copy_context().run, getVideoTags, videoId)
+                       for videoId in uncached]
+            for future in futures:
+                future.result()
+    return {videoId: checkNgTag(videoId, ngTags) for videoId in videoIds}
+
+
+# NOTE - 動画ID -> [APIによる引用可能性, 動画長（秒）, 紹介メッセージ]
+videoInfoCache = TtlLruCache(
+    int(config("VIDEO_CACHE_SIZE", default=2048)),
+    config("VIDEO_CACHE_PATH", default=None)
+)
+videoInfoTtl = float(config("VIDEO_CACHE_TTL", default=6 * 60 * 60))
+videoInfoNegativeTtl = float(config("VIDEO_CACHE_NEGATIVE_TTL", default=30 * 60))
+
+
+@retry(NetworkErrors, tries=3, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".fetchVideoInfo"))
+@metrics.timed(__name__ + ".fetchVideoInfo")
+def fetchVideoInfo(videoId: str, session: Session) -> Tuple[bool, int, str]:
+    # NOTE - 戻り値: (APIによる引用可能性, 動画長（秒）, 紹介メッセージ)
+    #        IGNORE_QUOTABLE_CHECKとNGタグはここでは考慮しない
     url = "https://lapi.spi.nicovideo.jp/v1/tools/live/quote/services/video/contents/{0}"
     resp = get(url.format(videoId), cookies=session.cookie)
     if resp.status_code == 403:
         session.login()
         raise ReLoggedIn("L12 ログインセッション更新")
     if resp.status_code == 500:
-        return (False, timedelta(seconds=0), "ERROR")
+        return (False, 0, "ERROR")
     resp.raise_for_status()
     videoData: Dict[str, Any] = dict(resp.json()).get("data", {})
-    if boolConfig("USE_OLD_VINFO_API", False):
+    if settings.current().useOldVideoInfoApi:
         # NOTE - This is old api
         if not "N_Q_GVI_WARNED_OLD_API" in globals():
             getLogger(__name__).warning("旧APIの呼び出し")
             global N_Q_GVI_WARNED_OLD_API
             N_Q_GVI_WARNED_OLD_API = True
-        quotable = boolConfig("IGNORE_QUOTABLE_CHECK", False)\
-            or videoData.get("quotable", False)
+        quotable = bool(videoData.get("quotable", False))
     else:
         url = "https://lapi.spi.nicovideo.jp/v1/services/select_content/video/{0}"
         resp = get(url.format(videoId), cookies=session.cookie)
@@ -133,16 +197,12 @@ def getVideoInfo(videoId: str, session: Session, ngTags: set) -> Tuple[bool, tim
             session.login()
             raise ReLoggedIn("L15 ログインセッション更新")
         if resp.status_code == 500:
-            return (False, timedelta(seconds=0), "ERROR")
+            return (False, 0, "ERROR")
         resp.raise_for_status()
         newApiVideoData: Dict[str, Any] = dict(resp.json())\
             .get("data", {}).get("content", {})
-        quotable = boolConfig("IGNORE_QUOTABLE_CHECK", False)\
-            or newApiVideoData.get("isQuotableByOtherContents", False)
-    # NOTE : 重いので引用可能動画のみNGタグの処理を行う
-    if quotable:
-        quotable = checkNgTag(videoId, ngTags)
-    length = timedelta(seconds=videoData.get("length", 0))
+        quotable = bool(newApiVideoData.get("isQuotableByOtherContents", False))
+    length = int(videoData.get("length", 0))
     introducing = "{0} / {1}".format(
         videoData.get("title", "（無題）"),
         videoData.get("id", "sm0")
@@ -150,8 +210,38 @@ def getVideoInfo(videoId: str, session: Session, ngTags: set) -> Tuple[bool, tim
     return (quotable, length, introducing)
 
 
-@retry(NetworkErrors, tries=10, delay=5, backoff=2, logger=getLogger(__name__ + ".once"))
-def once(liveId: str, videoId: str, session: Session) -> timedelta:
+def getVideoInfo(videoId: str, session: Session, ngTags: set) -> Tuple[bool, timedelta, str]:
+    # NOTE - 戻り値: (引用可能性, 動画長, 紹介メッセージ)
+    cached = videoInfoCache.get(videoId)
+    if cached is None:
+        cached = fetchVideoInfo(videoId, session)
+        # NOTE - HTTP 500はAPI側の一時的な障害の可能性があるため、キャッシュしない
+        #        引用不能のキャッシュは、APIが引用不能と応答した場合に限る
+        if cached[2] != "ERROR":
+            videoInfoCache.put(
+                videoId, list(cached),
+                videoInfoTtl if cached[0] else videoInfoNegativeTtl)
+    apiQuotable, lengthSeconds, introducing = cached
+    quotable = settings.current().ignoreQuotableCheck or apiQuotable
+    # NOTE : 重いので引用可能動画のみNGタグの処理を行う
+    if quotable:
+        quotable = checkNgTag(videoId, ngTags)
+    return (quotable, timedelta(seconds=lengthSeconds), introducing)
+
+
+def logCacheStats():
+    hits, misses, size = videoInfoCache.stats()
+    getLogger(__name__).info("動画情報キャッシュ: ヒット {0} / ミス {1} / 保持 {2}".format(
+        hits, misses, size))
+    hits, misses, size = videoTagsCache.stats()
+    getLogger(__name__).info("タグキャッシュ: ヒット {0} / ミス {1} / 保持 {2}".format(
+        hits, misses, size))
+
+
+@retry(NetworkErrors, tries=10, delay=5, backoff=2, logger=metrics.retryLogger(__name__ + ".once"))
+@metrics.timed(__name__ + ".once")
+def once(liveId: str, videoId: str, session: Session,
+         length: Optional[timedelta] = None) -> timedelta:
     stop(liveId, session)
 
     url = quoteBotUri
@@ -189,6 +279,8 @@ def once(liveId: str, videoId: str, session: Session) -> timedelta:
         raise RetryRequired("W01 引用拒否発生")
 
     resp.raise_for_status()
+    if length is not None:
+        return length
     postedVideoLength = getVideoInfo(videoId, session, set())[1]
     return postedVideoLength
 
@@ -198,7 +290,8 @@ def loop(liveId: str, videoId: str, session: Session):
     setLoop(liveId, session)
 
 
-@retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=getLogger(__name__ + ".setLoop"))
+@retry(NetworkErrors, tries=10, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".setLoop"))
+@metrics.timed(__name__ + ".setLoop")
 def setLoop(liveId: str, session: Session):
     sleep(1)
     url = quoteBotUri + "/layout"
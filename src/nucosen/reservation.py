@@ -0,0 +1,115 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - メンテナンスを避けて枠を予約する手順
+#        予約の試行は成功すると実際に枠が取れてしまうため、成功した時点で探索は終わる
+#        そのため、試行は常に最も長い枠から順に行い、失敗から分かったメンテナンスの
+#        位置を記憶しておくことで、同じメンテナンスに対する試行を省略する
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from typing import Callable, NamedTuple
+
+from nucosen import clock
+from nucosen.cache import TtlLruCache
+
+# NOTE - (開始時刻, 分) -> 予約できたらTrue、メンテナンスと重なればFalse
+Probe = Callable[[datetime, int], bool]
+
+
+class MaintenanceMemory(object):
+    # NOTE - 「この区間のどこかにメンテナンスがある」と分かった区間を記憶する
+    #        区間を丸ごと含む枠は、試行するまでもなく予約できない
+    def __init__(self, cache: TtlLruCache):
+        self.__cache = cache
+
+    def remember(self, begin: datetime, end: datetime):
+        ttl = (end - clock.now()).total_seconds() + 60 * 60
+        if ttl <= 0:
+            return
+        key = "{0}/{1}".format(begin.isoformat(), end.isoformat())
+        self.__cache.put(key, [begin.timestamp(), end.timestamp()], ttl)
+
+    def blocks(self, begin: datetime, end: datetime) -> bool:
+        beginAt, endAt = begin.timestamp(), end.timestamp()
+        return any(beginAt <= known[0] and known[1] <= endAt
+                   for known in self.__cache.values())
+
+
+class ReservationCost(NamedTuple):
+    calls: int
+    skipped: int
+
+
+def minutesBetween(begin: datetime, end: datetime) -> int:
+    return int((end - begin).total_seconds()) // 60
+
+
+def reserveAroundMaintenance(
+    probe: Probe,
+    start: datetime,
+    nextBoundary: Callable[[datetime], datetime],
+    memory: MaintenanceMemory,
+    step: int = 30
+) -> ReservationCost:
+    # NOTE - 1. 開始時刻を固定し、メンテナンスの手前までの枠を予約する
+    #        2. 開始時刻を遅らせ、メンテナンスの後から次の区切りまでの枠を予約する
+    calls = skipped = 0
+    end = nextBoundary(start)
+    duration = minutesBetween(start, end)
+    reservedUntil = start
+    if duration <= 0:
+        getLogger(__name__).warning("W21 枠予約アボート")
+    else:
+        while duration > 0:
+            windowEnd = start + timedelta(minutes=duration)
+            if memory.blocks(start, windowEnd):
+                skipped += 1
+            else:
+                calls += 1
+                if probe(start, duration):
+                    reservedUntil = windowEnd
+                    if windowEnd < end:
+                        memory.remember(
+                            windowEnd, windowEnd + timedelta(minutes=step))
+                    break
+                memory.remember(start, windowEnd)
+            duration -= step
+        else:
+            getLogger(__name__).error("E20 枠予約失敗")
+
+    # NOTE : 24時間後でも取れない場合はアボート
+    current = reservedUntil
+    for _ in range(24 * 60 // step):
+        end = nextBoundary(current)
+        if memory.blocks(current, end):
+            skipped += 1
+        else:
+            calls += 1
+            if probe(current, minutesBetween(current, end)):
+                if current > reservedUntil:
+                    memory.remember(current - timedelta(minutes=step), current)
+                break
+            memory.remember(current, end)
+        current += timedelta(minutes=step)
+    else:
+        getLogger(__name__).error("E21 枠予約失敗")
+    getLogger(__name__).info("メンテナンス回避予約の試行: {0}回（記憶により{1}回省略）".format(
+        calls, skipped))
+    return ReservationCost(calls, skipped)
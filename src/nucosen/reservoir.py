@@ -0,0 +1,157 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+from contextvars import Context
+from logging import getLogger
+from random import choice, shuffle
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+
+class CandidateReservoir(object):
+    # NOTE - タグ毎に審査済みの引用可能動画を蓄えておく
+    #        下限を割ったタグは別スレッドで上限まで補充する
+    #        search(タグ) : 候補の動画ID一覧、検索できない場合はNone
+    #        vet(動画ID)  : 引用可能ならTrue
+    def __init__(
+        self,
+        tags: Iterable[str],
+        search: Callable[[str], Optional[List[str]]],
+        vet: Callable[[str], bool],
+        lowWatermark: int,
+        highWatermark: int,
+        ttl: float
+    ):
+        self.__search = search
+        self.__vet = vet
+        self.lowWatermark = lowWatermark
+        self.highWatermark = highWatermark
+        self.ttl = ttl
+        self.__lock = Lock()
+        # NOTE - タグ -> (動画ID, 審査した時刻) 古い順
+        self.__pools: Dict[str, Deque[Tuple[str, float]]] = {
+            tag: deque() for tag in tags if tag != ""}
+        self.__refillRequested = Event()
+        self.__thread: Optional[Thread] = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__refillRequested.set()
+        # NOTE - 複数チャンネルで共有するため、補充は特定のチャンネルの設定に依らず行う
+        self.__thread = Thread(
+            target=lambda: Context().run(self.__refillLoop),
+            name="nucosen-reservoir", daemon=True)
+        self.__thread.start()
+
+    def addTags(self, tags: Iterable[str]):
+        # NOTE - 複数チャンネルの同時運用時に、後から起動したチャンネルのタグを加える
+        with self.__lock:
+            for tag in tags:
+                if tag != "" and tag not in self.__pools:
+                    self.__pools[tag] = deque()
+        self.__refillRequested.set()
+
+    def __poolsFor(self, tags: Optional[Iterable[str]]) -> List[Deque[Tuple[str, float]]]:
+        if tags is None:
+            return list(self.__pools.values())
+        return [self.__pools[tag] for tag in set(tags) if tag in self.__pools]
+
+    def draw(self, accept: Callable[[str], bool],
+             tags: Optional[Iterable[str]] = None) -> Optional[str]:
+        # NOTE - 蓄えからランダムなタグの動画を1件取り出す（tagsを指定するとそのタグに限る）
+        #        acceptがFalseを返した動画（NG動画など）は捨てて次を取り出す
+        while True:
+            with self.__lock:
+                now = monotonic()
+                for pool in self.__pools.values():
+                    while len(pool) > 0 and pool[0][1] + self.ttl < now:
+                        pool.popleft()
+                available = [pool for pool in self.__poolsFor(tags)
+                             if len(pool) > 0]
+                if any(len(pool) < self.lowWatermark
+                       for pool in self.__pools.values()):
+                    self.__refillRequested.set()
+                if len(available) == 0:
+                    return None
+                videoId = choice(available).popleft()[0]
+            if accept(videoId):
+                return videoId
+
+    def drawFitting(self, accept: Callable[[str], bool],
+                    tags: Optional[Iterable[str]] = None) -> Optional[str]:
+        # NOTE - acceptを満たす動画を1件取り出す（枠末尾の穴埋め用）
+        #        drawと異なり、満たさない動画は捨てずに蓄えに残す
+        with self.__lock:
+            now = monotonic()
+            candidates = [videoId for pool in self.__poolsFor(tags)
+                          for videoId, vettedAt in pool if vettedAt + self.ttl >= now]
+        shuffle(candidates)
+        for videoId in candidates:
+            if not accept(videoId):
+                continue
+            with self.__lock:
+                for pool in self.__pools.values():
+                    for entry in pool:
+                        if entry[0] == videoId:
+                            pool.remove(entry)
+                            return videoId
+        return None
+
+    def size(self) -> int:
+        with self.__lock:
+            return sum(len(pool) for pool in self.__pools.values())
+
+    def __refillLoop(self):
+        while True:
+            self.__refillRequested.wait(self.ttl)
+            self.__refillRequested.clear()
+            for tag in list(self.__pools.keys()):
+                try:
+                    self.__refill(tag)
+                except Exception as e:
+                    getLogger(__name__).info(
+                        "リザーバーの補充に失敗しました {0} {1}".format(tag, e))
+
+    def __refill(self, tag: str):
+        with self.__lock:
+            pool = self.__pools[tag]
+            if len(pool) >= self.lowWatermark:
+                return
+            known = set(videoId for videoId, _ in pool)
+        candidates = self.__search(tag)
+        if candidates is None:
+            return
+        added = 0
+        for candidate in candidates:
+            if candidate in known:
+                continue
+            with self.__lock:
+                if len(pool) >= self.highWatermark:
+                    break
+            if not self.__vet(candidate):
+                continue
+            with self.__lock:
+                pool.append((candidate, monotonic()))
+            known.add(candidate)
+            added += 1
+        getLogger(__name__).debug(
+            "リザーバーを補充しました {0} +{1}".format(tag, added))
@@ -0,0 +1,173 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 全てのリトライを司るプログラム
+#        ・待ち時間は指数的に伸ばし、上限と揺らぎ（ジッター）を加える
+#        ・deadlineで期限を設定すると、期限を越えて待つリトライは行わない
+#        ・ホスト毎のサーキットブレーカーが開いている間は、通信せずにすぐ失敗する
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from logging import getLogger
+from os import getcwd
+from random import uniform
+from threading import Lock
+from typing import (Any, Callable, ContextManager, Dict, Iterator, Optional,
+                    Tuple, Type, Union)
+
+from decouple import AutoConfig
+
+from nucosen.clock import monotonic, now, sleep
+
+config = AutoConfig(getcwd())
+
+maxDelay = float(config("RETRY_MAX_DELAY", default=60))
+# NOTE - 待ち時間のうち、ランダムに短縮する割合（0～1）
+jitter = float(config("RETRY_JITTER", default=0.5))
+# NOTE - 連続してこの回数失敗したホストへの通信を、cooldown秒間遮断する
+circuitFailures = int(config("CIRCUIT_FAILURES", default=5))
+circuitCooldown = float(config("CIRCUIT_COOLDOWN", default=30))
+
+Exceptions = Union[Type[BaseException], Tuple[Type[BaseException], ...]]
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# NOTE - 単調時計での期限。Noneは期限なし
+deadlineVar: ContextVar[Optional[float]] = ContextVar(
+    "nucosenRetryDeadline", default=None)
+
+
+@contextmanager
+def deadline(at: float) -> Iterator[None]:
+    # NOTE - 入れ子にした場合は早い方の期限が有効になる
+    current = deadlineVar.get()
+    token = deadlineVar.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        deadlineVar.reset(token)
+
+
+def deadlineAt(limit: datetime) -> ContextManager[None]:
+    return deadline(monotonic() + (limit - now()).total_seconds())
+
+
+def retryCall(function: Callable, exceptions: Exceptions, tries: int, delay: float,
+              backoff: float, logger) -> Any:
+    remaining, wait = tries, delay
+    while True:
+        try:
+            return function()
+        except exceptions as e:
+            remaining -= 1
+            if remaining == 0:
+                raise
+            pause = min(wait, maxDelay)
+            pause -= uniform(0, pause * jitter)
+            limit = deadlineVar.get()
+            if limit is not None and monotonic() + pause > limit:
+                raise DeadlineExceeded(
+                    "W51 期限までにリトライできません {0}".format(e)) from e
+            if logger is not None:
+                logger.warning("%s, retrying in %s seconds...", e, round(pause, 2))
+            sleep(pause)
+            wait *= backoff
+
+
+def retry(exceptions: Exceptions = Exception, tries: int = -1, delay: float = 0,
+          backoff: float = 1, logger=getLogger(__name__)) -> Callable:
+    # NOTE - retryパッケージのretryデコレーターと同じ引数で使用できる
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            return retryCall(
+                lambda: function(*args, **kwargs),
+                exceptions, tries, delay, backoff, logger)
+        return wrapper
+    return decorator
+
+
+class CircuitBreaker(object):
+    def __init__(self, host: str):
+        self.host = host
+        self.__lock = Lock()
+        self.__failures = 0
+        self.__openedAt: Optional[float] = None
+        self.__trial = False
+
+    def before(self):
+        # NOTE - 遮断中は通信せずに失敗する
+        #        遮断から一定時間経過後は、試しに1件だけ通信を通す
+        with self.__lock:
+            if self.__openedAt is None:
+                return
+            if monotonic() - self.__openedAt < circuitCooldown or self.__trial:
+                raise CircuitOpen("W50 通信を遮断中です {0}".format(self.host))
+            self.__trial = True
+
+    def success(self):
+        with self.__lock:
+            if self.__openedAt is not None:
+                getLogger(__name__).info("通信の遮断を解除しました {0}".format(self.host))
+            self.__failures = 0
+            self.__openedAt = None
+            self.__trial = False
+
+    def abandon(self):
+        # NOTE - 試しに通した通信が、成否を判定できない例外で終わった場合に呼び出す
+        #        遮断の状態は変えず、次の通信で改めて試す
+        with self.__lock:
+            self.__trial = False
+
+    def failure(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.__trial or (self.__openedAt is None and self.__failures >= circuitFailures):
+                if self.__openedAt is None:
+                    getLogger(__name__).warning(
+                        "W50 通信を遮断します {0} ({1}回連続失敗)".format(
+                            self.host, self.__failures))
+                self.__openedAt = monotonic()
+                self.__trial = False
+
+    @property
+    def isOpen(self) -> bool:
+        with self.__lock:
+            return self.__openedAt is not None
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+breakersLock = Lock()
+
+
+def breakerFor(host: str) -> CircuitBreaker:
+    with breakersLock:
+        breaker = breakers.get(host)
+        if breaker is None:
+            breaker = breakers[host] = CircuitBreaker(host)
+        return breaker
@@ -17,19 +17,27 @@ You should have received a copy of the GNU Affero General Public License
 along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
+import os
+from contextvars import copy_context
 from dataclasses import dataclass
 from logging import getLogger
-from typing import Optional
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional
 
 from pyotp import TOTP
-from requests import Response, get, post
-from requests.cookies import RequestsCookieJar
+from requests import Response
+from requests.cookies import RequestsCookieJar, create_cookie
 from requests.exceptions import ConnectionError as ConnError
-from requests.exceptions import HTTPError
-from retry import retry
+from requests.exceptions import HTTPError, RequestException
 from decouple import AutoConfig
 from os import getcwd
 
+from nucosen import metrics, settings
+from nucosen.httpClient import get, post
+from nucosen.retryPolicy import CircuitOpen, retry
+
 class ReLoginRequested(Exception):
     pass
 
@@ -37,6 +45,10 @@ config = AutoConfig(getcwd())
 NetworkErrors = (ConnError, HTTPError, ReLoginRequested)
 UserAgent = str(config("NUCOSEN_UA_PREFIX", default="anonymous")
                 ) + " / NUCOSen Automatic Login"
+# NOTE - ログインからこの秒数が経つか、クッキーの有効期限のこの秒数前になると、
+#        別スレッドで先行して再ログインする
+refreshAge = float(config("SESSION_REFRESH_AGE", default=6 * 60 * 60))
+refreshMargin = float(config("SESSION_REFRESH_MARGIN", default=10 * 60))
 
 @dataclass
 class Session(object):
@@ -46,9 +58,35 @@ class Session(object):
 
     user_agent: str = UserAgent
     cookie: Optional[RequestsCookieJar] = None
+    # NOTE - ログインした時刻（UNIX時間）と、ログインの度に進む世代
+    loggedInAt: float = 0.0
+    generation: int = 0
+
+    def __post_init__(self):
+        self.__loginLock = Lock()
+        self.__refresher: Optional[Thread] = None
+        self.__closed = Event()
+        # NOTE - 指定するとログインセッションを保存し、再起動時に再利用する
+        #        ファイルは所有者のみ読み書きできる権限（600）で作成する
+        #        複数チャンネルの同時運用時は、チャンネル毎の値を使用する
+        self.__cookiePath: Optional[str] = settings.lookup(
+            "SESSION_COOKIE_PATH", default=None)
 
-    @retry(NetworkErrors, tries=3, delay=1, backoff=2, logger=getLogger(__name__ + ".login"))
     def login(self):
+        # NOTE - 同時に呼び出された場合はログインを1回だけ行い、
+        #        他の呼び出しはその完了を待って結果を共有する
+        generation = self.generation
+        with self.__loginLock:
+            if self.generation != generation:
+                return
+            self.authenticate()
+            self.loggedInAt = time()
+            self.generation += 1
+        self.save()
+
+    @retry(NetworkErrors, tries=3, delay=1, backoff=2, logger=metrics.retryLogger(__name__ + ".login"))
+    @metrics.timed(__name__ + ".login")
+    def authenticate(self):
         header = {
             "User-Agent": self.user_agent,
             "Content-Type": "application/x-www-form-urlencoded"
@@ -73,6 +111,129 @@ class Session(object):
             return
         raise ReLoginRequested("L15 ログイン失敗")
 
+    def resume(self):
+        # NOTE - 保存済みのログインセッションが有効ならそれを使い、無効ならログインする
+        startedAt = perf_counter()
+        if self.load() and self.validate():
+            getLogger(__name__).info("保存済みのログインセッションを再利用しました")
+        else:
+            self.login()
+        getLogger(__name__).info("認証完了までの時間: {0:.2f}秒".format(
+            perf_counter() - startedAt))
+
+    def refreshAt(self) -> float:
+        # NOTE - 先行して再ログインするUNIX時刻
+        due = self.loggedInAt + refreshAge
+        if self.cookie is not None:
+            for cookie in self.cookie:
+                if cookie.name == "user_session" and cookie.expires is not None:
+                    due = min(due, cookie.expires - refreshMargin)
+        return due
+
+    def startRefresher(self):
+        if refreshAge <= 0 or self.__refresher is not None:
+            return
+        # NOTE - チャンネル毎の設定とログのチャンネル名を引き継ぐ
+        self.__refresher = Thread(
+            target=copy_context().run, args=(self.__refreshLoop,),
+            name="nucosen-session-refresh", daemon=True)
+        self.__refresher.start()
+
+    def __refreshLoop(self):
+        while not self.__closed.is_set():
+            # NOTE - 他の箇所で再ログインした場合に備え、最長1分毎に予定を確認し直す
+            remaining = self.refreshAt() - time()
+            if remaining > 0:
+                self.__closed.wait(min(remaining, 60))
+                continue
+            getLogger(__name__).info("ログインセッションの期限が近いため再ログインします")
+            try:
+                self.login()
+            except Exception as e:
+                getLogger(__name__).warning(
+                    "W42 ログインセッションを更新できません {0}".format(e))
+                self.__closed.wait(60)
+
+    def close(self):
+        # NOTE - 先行して再ログインするスレッドを止める
+        #        放送ループの再起動時に、前回のセッションが再ログインを続けないようにする
+        self.__closed.set()
+        self.__refresher = None
+
+    def validate(self) -> bool:
+        # NOTE - 軽量なAPIを1回だけ呼び出し、ログインセッションが有効か確かめる
+        sessionString = self.getSessionString()
+        if sessionString is None:
+            return False
+        try:
+            resp = get(
+                "https://live2.nicovideo.jp/unama/tool/v2/onairs/user",
+                headers={
+                    "X-niconico-session": sessionString,
+                    "User-Agent": self.user_agent,
+                })
+        except (RequestException, CircuitOpen):
+            # NOTE - 確かめられない場合は無効として扱い、呼び出し側でログインし直す
+            return False
+        return resp.status_code == 200
+
+    def save(self):
+        cookiePath = self.__cookiePath
+        if cookiePath is None or self.cookie is None:
+            return
+        cookies: List[Dict[str, Any]] = [{
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "expires": cookie.expires,
+            "secure": cookie.secure,
+        } for cookie in self.cookie]
+        temporaryPath = cookiePath + ".tmp"
+        try:
+            descriptor = os.open(
+                temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                json.dump({
+                    "mail_tel": self.mail_tel,
+                    "loggedInAt": self.loggedInAt,
+                    "cookies": cookies,
+                }, file)
+            os.chmod(temporaryPath, 0o600)
+            os.replace(temporaryPath, cookiePath)
+        except OSError as e:
+            getLogger(__name__).warning("W40 ログインセッションを保存できません {0}".format(e))
+
+    def load(self) -> bool:
+        cookiePath = self.__cookiePath
+        if cookiePath is None or not os.path.exists(cookiePath):
+            return False
+        try:
+            if os.stat(cookiePath).st_mode & 0o077:
+                getLogger(__name__).warning(
+                    "W41 ログインセッションの権限が広すぎるため使用しません {0}".format(cookiePath))
+                return False
+            with open(cookiePath, encoding="utf-8") as file:
+                saved = json.load(file)
+        except (OSError, ValueError) as e:
+            getLogger(__name__).info("保存済みのログインセッションを読み込めません {0}".format(e))
+            return False
+        if saved.get("mail_tel") != self.mail_tel:
+            return False
+        jar = RequestsCookieJar()
+        for cookie in saved.get("cookies", []):
+            if cookie.get("expires") is not None and cookie["expires"] < time():
+                continue
+            jar.set_cookie(create_cookie(
+                cookie["name"], cookie["value"],
+                domain=cookie.get("domain", ""), path=cookie.get("path", "/"),
+                expires=cookie.get("expires"), secure=bool(cookie.get("secure"))))
+        if "user_session" not in jar:
+            return False
+        self.cookie = jar
+        self.loggedInAt = float(saved.get("loggedInAt", 0))
+        return True
+
     def __mfa_login(self, resp: Response, header):
         tfac = TOTP(self.mfa_token)
         mfaResp = post(
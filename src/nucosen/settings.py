@@ -0,0 +1,222 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 放送の運用に関わる設定を一度だけ読み込み、変更できない形で各プログラムに渡す
+#        SIGHUPを受け取ると設定を読み直し、丸ごと差し替える（NGリストの変更などに再起動は不要）
+#        読み直しはシグナルハンドラでは行わず、放送ループがreloadIfRequestedを呼んだ時点で行う
+#        通信先やキャッシュの大きさなど、起動時にしか反映されない設定はここには含まない
+
+import signal
+from contextvars import ContextVar
+from dataclasses import dataclass, fields
+from logging import getLogger
+from os import getcwd
+from threading import Event, Lock
+from typing import Any, Dict, FrozenSet, Mapping, Optional, Tuple
+
+from decouple import AutoConfig, strtobool
+
+
+@dataclass(frozen=True)
+class Settings(object):
+    mailTel: str
+    password: str
+    mfaToken: str
+    liveTitle: str
+    communityId: str
+    tags: Tuple[str, ...]
+    reqTags: Tuple[str, ...]
+    ngTags: FrozenSet[str]
+    ngVideoIds: FrozenSet[str]
+    maintenanceVideoId: str
+    closingVideoId: str
+    maintenanceMessage: str
+    closingMessage: str
+    duration: int
+    retryDeadlineMargin: float
+    minAllowableDuration: int
+    maxAllowableDuration: int
+    ignoreQuotableCheck: bool
+    useOldVideoInfoApi: bool
+    requestCapPerRequester: int
+    requestCarryOver: float
+
+    @property
+    def loginInfo(self) -> Tuple[str, str, str]:
+        return (self.mailTel, self.password, self.mfaToken)
+
+
+@dataclass(frozen=True)
+class Channel(object):
+    # NOTE - 複数チャンネルの同時運用時の1チャンネル分の設定
+    #        valuesの値は、設定ファイル・環境変数より優先する
+    name: str
+    values: Mapping[str, Any]
+
+
+class ChannelConfig(object):
+    # NOTE - AutoConfigと同じ呼び出し方で、チャンネル毎の値を優先して返す
+    def __init__(self, base: AutoConfig, channel: Channel):
+        self.base = base
+        self.channel = channel
+
+    def __call__(self, key: str, default: Any = None, cast: Any = None) -> Any:
+        if key not in self.channel.values:
+            if cast is None:
+                return self.base(key, default=default)
+            return self.base(key, default=default, cast=cast)
+        value = self.channel.values[key]
+        if cast is bool:
+            return strtobool(value if isinstance(value, bool) else str(value))
+        return value if cast is None else cast(value)
+
+
+# NOTE - 実行中のチャンネル（複数チャンネルの同時運用時のみ）
+channelVar: ContextVar[Optional[Channel]] = ContextVar(
+    "nucosenChannel", default=None)
+
+
+def lookup(key: str, default: Any = None, cast: Any = None) -> Any:
+    # NOTE - 起動時にのみ使用する設定（データベースの接続先など）を、実行中のチャンネルの値で読む
+    config = configFor(channelVar.get())
+    if cast is None:
+        return config(key, default=default)
+    return config(key, default=default, cast=cast)
+
+
+def configFor(channel: Optional[Channel]) -> Any:
+    base = AutoConfig(getcwd())
+    return base if channel is None else ChannelConfig(base, channel)
+
+
+def splitList(value: str) -> Tuple[str, ...]:
+    return tuple(value.split(","))
+
+
+def load(channel: Optional[Channel] = None) -> Settings:
+    # NOTE - 設定ファイルを読み直すため、毎回新しいAutoConfigを使用する
+    config = configFor(channel)
+
+    def text(key: str, default: str = "") -> str:
+        return str(config(key, default=default))
+
+    minimum = config("MIN_ALLOWABLE_DURATION", default=45, cast=int)
+    maximum = config("MAX_ALLOWABLE_DURATION", default=10 * 60, cast=int)
+    if maximum < minimum:
+        maximum = minimum + (10 * 60)
+    carryOver = config("REQUEST_CARRY_OVER", default=0, cast=float)
+    if not 0 <= carryOver < 1:
+        raise ValueError("REQUEST_CARRY_OVER {0}".format(carryOver))
+    return Settings(
+        mailTel=text("NICO_ID"),
+        password=text("NICO_PW"),
+        mfaToken=text("NICO_TFA"),
+        liveTitle=text("LIVE_TITLE"),
+        communityId=text("COMMUNITY"),
+        tags=splitList(text("TAGS")),
+        reqTags=splitList(text("REQTAGS")),
+        ngTags=frozenset(tag for tag in splitList(text("NG_TAGS")) if tag != ""),
+        ngVideoIds=frozenset(
+            videoId for videoId in splitList(text("NG_VIDEO_IDS")) if videoId != ""),
+        maintenanceVideoId=text("MAINTENANCE_VIDEO_ID") or "sm17759202",
+        closingVideoId=text("CLOSING_VIDEO_ID") or "sm17572946",
+        maintenanceMessage=text("NUCOSEN_MAINTENANCE_MESSAGE") or
+        "システムが異常停止したため、自動回復機能により復旧しました。\n" +
+        "ご迷惑をおかけし大変申し訳ございません。まもなく再開いたします。",
+        closingMessage=text("NUCOSEN_CLOSING_MESSAGE") or
+        "この枠の放送は終了しました。\nご視聴ありがとうございました。",
+        duration=config("DURATION_OVERWRITE", default=360, cast=int),
+        retryDeadlineMargin=config("RETRY_DEADLINE_MARGIN", default=10, cast=float),
+        minAllowableDuration=minimum,
+        maxAllowableDuration=maximum,
+        ignoreQuotableCheck=config("IGNORE_QUOTABLE_CHECK", default=False, cast=bool),
+        useOldVideoInfoApi=config("USE_OLD_VINFO_API", default=False, cast=bool),
+        requestCapPerRequester=config("REQUEST_CAP_PER_REQUESTER", default=0, cast=int),
+        requestCarryOver=carryOver,
+    )
+
+
+# NOTE - 呼び出し元毎に設定を差し替える場合（複数チャンネルの同時運用など）に使用する
+overrideVar: ContextVar[Optional[Settings]] = ContextVar(
+    "nucosenSettings", default=None)
+# NOTE - チャンネル名（単独運用時はNone） -> (チャンネル, 設定)
+loaded: Dict[Optional[str], Tuple[Optional[Channel], Settings]] = {}
+loadLock = Lock()
+# NOTE - SIGHUPによる再読み込みの要求
+reloadRequested = Event()
+
+
+def current() -> Settings:
+    override = overrideVar.get()
+    if override is not None:
+        return override
+    channel = channelVar.get()
+    name = None if channel is None else channel.name
+    entry = loaded.get(name)
+    if entry is None:
+        with loadLock:
+            entry = loaded.get(name)
+            if entry is None:
+                entry = loaded[name] = (channel, load(channel))
+    return entry[1]
+
+
+def reload() -> bool:
+    # NOTE - 読み込みに失敗した場合は現在の設定を使い続ける
+    #        1つでも失敗した場合は、どのチャンネルの設定も差し替えない
+    try:
+        renewed = {name: (channel, load(channel))
+                   for name, (channel, _) in list(loaded.items())}
+    except Exception as e:
+        getLogger(__name__).warning("W60 設定を再読み込みできません {0}".format(e))
+        return False
+    with loadLock:
+        previous = dict(loaded)
+        loaded.update(renewed)
+    for name, (_, snapshot) in renewed.items():
+        changed = [field.name for field in fields(Settings)
+                   if getattr(previous[name][1], field.name) != getattr(snapshot, field.name)]
+        getLogger(__name__).info("設定を再読み込みしました{0} 変更: {1}".format(
+            "" if name is None else " ({0})".format(name), ", ".join(changed) or "なし"))
+    return True
+
+
+def reloadIfRequested() -> bool:
+    # NOTE - 再読み込みの要求があれば、呼び出し元のスレッドで読み直す
+    #        複数チャンネルの同時運用時は、最初に呼び出したチャンネルが全チャンネル分を読み直す
+    if not reloadRequested.is_set():
+        return False
+    reloadRequested.clear()
+    return reload()
+
+
+def installReloadHandler():
+    # NOTE - SIGHUPの無い環境（Windows）やメインスレッド以外では何もしない
+    #        シグナルハンドラは要求を記録するだけにする
+    #        （ハンドラ内で読み込むと、中断したスレッドが持つロックと競合しうる）
+    hangUp = getattr(signal, "SIGHUP", None)
+    if hangUp is None:
+        return
+
+    def handler(signum, frame):
+        reloadRequested.set()
+    try:
+        signal.signal(hangUp, handler)
+    except ValueError:
+        pass
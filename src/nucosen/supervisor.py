@@ -0,0 +1,136 @@
+"""
+Copyright 2022 NUCOSen運営会議
+
+This file is part of NUCOSen Broadcast.
+
+NUCOSen Broadcast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+NUCOSen Broadcast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with NUCOSen Broadcast.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# NOTE - 1つのプロセスで複数チャンネルの放送ループを動かす
+#        通信の接続・動画情報やタグのキャッシュ・ランダム放送の候補はチャンネル間で共有する
+#        設定・キュー・ログインセッション・チェックポイント・リクエスト抽選の持ち越しはチャンネル毎に持つ
+#        チャンネル毎に別スレッドで動かし、1つのチャンネルが停止しても他のチャンネルは放送を続ける
+#        停止したチャンネルは、間隔を空けて自動で再起動する
+#        チャンネルのスレッドから起動するスレッド（先読み・審査・再ログイン・キュー項目の削除）は、
+#        チャンネルのコンテキスト（設定・ログのチャンネル名）を引き継ぐ
+
+import json
+from logging import Filter, LogRecord, getLogger
+from os import getcwd
+from threading import Thread
+from typing import Any, Dict, List, Optional
+
+from decouple import AutoConfig
+
+from nucosen import clock, engines, nucosen, settings
+
+config = AutoConfig(getcwd())
+# NOTE - 再起動までの待ち時間（秒）。続けて停止する度に倍にし、上限で止める
+restartDelay = float(config("CHANNEL_RESTART_DELAY", default=30))
+restartDelayMax = float(config("CHANNEL_RESTART_DELAY_MAX", default=15 * 60))
+# NOTE - ログインなどが一斉に行われないよう、チャンネルの起動をずらす間隔（秒）
+startInterval = float(config("CHANNEL_START_INTERVAL", default=2))
+
+# NOTE - チャンネル毎に異なるファイルが必要な設定と、その既定値
+#        チャンネルの設定で指定しない場合は、既定値の末尾にチャンネル名を付ける
+PerChannelPaths: Dict[str, Optional[str]] = {
+    "QUEUE_JOURNAL_PATH": ".nucosen-queue.journal",
+    "SQLITE_PATH": "nucosen.sqlite3",
+    "SESSION_COOKIE_PATH": None,
+    "CHECKPOINT_PATH": ".nucosen-checkpoint.json",
+}
+
+
+def loadChannels(path: str) -> List[settings.Channel]:
+    # NOTE - {"channels": [{"name": "main", "COMMUNITY": "co123", ...}, ...]}
+    #        name以外の項目は環境変数と同じ名前で、設定ファイル・環境変数より優先する
+    with open(path, encoding="utf-8") as file:
+        loaded: Dict[str, Any] = json.load(file)
+    channels: List[settings.Channel] = []
+    for entry in loaded.get("channels", []):
+        values = dict(entry)
+        name = str(values.pop("name", ""))
+        if name == "" or name in [channel.name for channel in channels]:
+            raise Exception("V0E チャンネル名が無いか重複しています {0}".format(name))
+        for key, default in PerChannelPaths.items():
+            if key in values:
+                continue
+            base = config(key, default=default)
+            if base is not None:
+                values[key] = "{0}.{1}".format(base, name)
+        channels.append(settings.Channel(name, values))
+    if len(channels) < 1:
+        raise Exception("V0E チャンネルが1つも設定されていません {0}".format(path))
+    return channels
+
+
+class ChannelFilter(Filter):
+    # NOTE - ログにチャンネル名（record.channel）を付ける
+    def filter(self, record: LogRecord) -> bool:
+        channel = settings.channelVar.get()
+        record.channel = "-" if channel is None else channel.name
+        return True
+
+
+def runChannel(channel: settings.Channel, scheduler: clock.Scheduler,
+               engine: engines.Engine):
+    logger = getLogger(__name__)
+    settings.channelVar.set(channel)
+    delay = restartDelay
+    while True:
+        startedAt = clock.monotonic()
+        try:
+            nucosen.run(scheduler, engine)
+        except SystemExit:
+            pass
+        if scheduler.stopping:
+            return
+        # NOTE - 長く動いた後の停止は、連続した停止とみなさない
+        if clock.monotonic() - startedAt > restartDelayMax:
+            delay = restartDelay
+        logger.warning("W70 放送ループが停止しました。{0:.0f}秒後に再起動します".format(delay))
+        try:
+            scheduler.wait(clock.monotonic() + delay)
+        except clock.ShutdownRequested:
+            return
+        delay = min(delay * 2, restartDelayMax)
+
+
+def run(path: str, engine: Optional[engines.Engine] = None):
+    # NOTE - AsyncEngineを指定した場合は、チャンネル毎のスレッドでそれぞれイベントループを動かす
+    logger = getLogger(__name__)
+    channels = loadChannels(path)
+    settings.installReloadHandler()
+    clock.installSignalHandlers(clock.scheduler)
+    logger.info("{0}チャンネルの放送を開始します: {1}".format(
+        len(channels), ", ".join(channel.name for channel in channels)))
+
+    threads: List[Thread] = []
+    try:
+        for channel in channels:
+            thread = Thread(
+                target=runChannel,
+                args=(channel, clock.scheduler.child(), engine or engines.BlockingEngine()),
+                name="nucosen-channel-" + channel.name, daemon=True)
+            thread.start()
+            threads.append(thread)
+            clock.scheduler.wait(clock.monotonic() + startInterval)
+        # NOTE - メインスレッドはシグナルを受け取るため、短い間隔で待機する
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+    except clock.ShutdownRequested:
+        for thread in threads:
+            thread.join()
+    logger.info("全チャンネルの放送を停止しました")